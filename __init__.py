@@ -1,38 +1,65 @@
 import os.path as osp
-import json
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import to_rgb
-from time import time
-from sklearn.cluster import KMeans
 
 from config import *
+from reducer import block_mean, area_mean, strip_block_mean, strip_area_mean
+from ingest import ImageSource
+from palette import palette_index, palette_table, extract_palette, load_rgb
+from cache import ResultCache, file_hash
+from profiler import Profiler
 
 
 class PixelInit(object):
 
-    def __init__(self, image, orientation, halign, valign, dimension, colours, pixelsize):
-        self.start_time = time()
-        self.__image__(image)
+    def __init__(self, image, orientation, halign, valign, dimension, colours, pixelsize, resample='crop', palette_method='kmeans', metric='rgb', no_cache=0, strip_rows=0, profile=0):
+        self.profile = profile
+        self.profiler = Profiler(cprofile=self.profile)
+        self.__cache__(no_cache)
+        self.__image__(image, strip_rows)
         self.__orientation__(orientation)
         self.__halign__(halign)
         self.__valign__(valign)
         self.__dimension__(dimension)
+        self.__resample__(resample)
         self.__reducer__()
+        self.__palette_method__(palette_method)
+        self.__metric__(metric)
         self.__colours__(colours)
         self.__pixelsize__(pixelsize)
         print(f'Time to setup: {self.timer()}')
         
-    def __image__(self, image):
+    def __cache__(self, no_cache):
+        self.no_cache = no_cache
+        if self.no_cache:
+            self.cache = None
+        else:
+            self.cache = ResultCache()
+        self.stage_keys = {}
+
+    def __image__(self, image, strip_rows):
         assert osp.exists(image)
         self.image = image
-        self.im = plt.imread(self.image)
+        self.strip_rows = strip_rows
+        self.source = ImageSource(self.image)
+        self.imx = self.source.imx
+        self.imy = self.source.imy
+
+    def load_image(self):
+        if self.image.endswith('.npy'):
+            self.im = self.source.read(0, self.imx)
+            return
+        from matplotlib.image import imread
+        self.im = imread(self.image)
         if np.size(self.im, axis=-1) > RGB_DIM:
             self.im = self.im[:,:,:RGB_DIM]*self.im[:,:,RGB_DIM:]
         if np.max(self.im) > 1:
             self.im = self.im/RGB_MAX_INT
-        self.imx = np.size(self.im, axis=0)
-        self.imy = np.size(self.im, axis=1)
+
+    def cached(self, stage, params, compute):
+        if self.cache is None:
+            return compute()
+        arrays, self.stage_keys[stage] = self.cache.cached(stage, params, compute)
+        return arrays
 
     def __orientation__(self, orientation):
         assert orientation in ['default', 'v', 'vertical', 'h', 'horizontal']
@@ -74,112 +101,147 @@ class PixelInit(object):
             self.xalign = float(self.valign)
         self.xalign = 1 - self.xalign
 
+    @staticmethod
+    def split_size(size):
+        assert size.count('x') <= 1
+        if 'x' not in size:
+            return int(size), int(size)
+        else:
+            first, second = size.split('x')
+            return int(first), int(second)
+
     def __dimension__(self, dimension):
-        assert dimension.count('x') <= 1
         self.dimension = dimension
-        if 'x' not in self.dimension:
-            self.ydim = int(self.dimension)
-            self.xdim = int(self.dimension)
-        else:
-            self.ydim, self.xdim = self.dimension.split('x')
-            self.ydim = int(self.ydim)
-            self.xdim = int(self.xdim)
+        self.ydim, self.xdim = self.split_size(self.dimension)
         self.nx = self.pixelplate[0]*self.xdim
         self.ny = self.pixelplate[1]*self.ydim
 
+    def __resample__(self, resample):
+        assert resample in ['crop', 'area']
+        self.resample = resample
+
     def __reducer__(self):
-        mult = min(
-            int(self.imx/self.nx),
-            int(self.imy/self.ny),
-        )
-        assert mult > 0
-        dx = self.imx - mult*self.nx
-        dx = int(0.5 + self.xalign*dx)
-        dy = self.imy - mult*self.ny
-        dy = int(0.5 + self.yalign*dy)
-        self.rim = np.zeros((self.nx, self.ny, RGB_DIM))
-        for i in range(self.nx):
-            for j in range(self.ny):
-                self.rim[i,j,:] = np.mean(np.mean(
-                    self.im[
-                        dx + mult*i:dx + mult + mult*i,
-                        dy + mult*j:dy + mult + mult*j,
-                    :],
-                axis=0), axis=0)
+        if self.cache is not None:
+            params = [
+                file_hash(self.image),
+                self.pixelplate,
+                self.xalign,
+                self.yalign,
+                self.nx,
+                self.ny,
+                self.resample,
+                self.strip_rows > 0,
+            ]
+        else:
+            params = None
+        self.rim = self.cached('rim', params, lambda: {'rim' : self.reduce()})['rim']
+
+    def reduce(self):
+        if not self.strip_rows:
+            with self.profiler.stage('image'):
+                self.load_image()
+        with self.profiler.stage('reduce'):
+            return self.reduce_image()
+
+    def reduce_image(self):
+        if self.resample == 'area':
+            if self.strip_rows:
+                return strip_area_mean(self.source, self.nx, self.ny, self.xalign, self.yalign, self.strip_rows)
+            return area_mean(self.im, self.nx, self.ny, self.xalign, self.yalign)
+        else:
+            mult = min(
+                int(self.imx/self.nx),
+                int(self.imy/self.ny),
+            )
+            assert mult > 0
+            dx = self.imx - mult*self.nx
+            dx = int(0.5 + self.xalign*dx)
+            dy = self.imy - mult*self.ny
+            dy = int(0.5 + self.yalign*dy)
+            if self.strip_rows:
+                return strip_block_mean(self.source, self.nx, self.ny, mult, dx, dy, self.strip_rows)
+            return block_mean(self.im, self.nx, self.ny, mult, dx, dy)
+
+    def __palette_method__(self, palette_method):
+        assert palette_method in ['kmeans', 'minibatch', 'histogram', 'mediancut']
+        self.palette_method = palette_method
+
+    def __metric__(self, metric):
+        assert metric in ['rgb', 'lab', 'oklab']
+        self.metric = metric
 
     def __colours__(self, colours):
         self.colours = colours
-        with open(RGB_DICT, 'r') as d:
-            rgb = json.load(d)
+        rgb = load_rgb()
+        if self.cache is not None:
+            params = [file_hash(RGB_DICT), self.colours, self.palette_method, self.metric]
+            if self.colours.startswith('top') and self.colours.endswith('image'):
+                params.append(self.stage_keys['rim'])
+        else:
+            params = None
+        with self.profiler.stage('palette'):
+            keys = self.cached('rgb', params, lambda: {'keys' : self.colour_keys(rgb)})['keys']
+        self.rgb = {str(key) : rgb[str(key)] for key in keys}
+        self.colour_table, self.numbers = palette_table(self.rgb)
+
+    @staticmethod
+    def preset_colours(colours):
+        if colours == 'primary':
+            return 'blue-red-yellow'
+        elif colours == 'basic':
+            return 'white-tab:blue-tab:red-tab:green-tab:pink-tab:orange-tab:brown'
+        elif colours == 'classic':
+            return 'peachpuff-crimson-ivory-gold-royalblue-navy-forestgreen'
+        else:
+            return colours
+
+    def colour_keys(self, rgb):
         if self.colours == 'all':
-            self.rgb = rgb.copy()
+            return list(rgb)
         else:
-            if self.colours == 'primary':
-                keys = 'blue-red-yellow'
-            elif self.colours == 'basic':
-                keys = 'white-tab:blue-tab:red-tab:green-tab:pink-tab:orange-tab:brown'
-            elif self.colours == 'classic':
-                keys = 'peachpuff-crimson-ivory-gold-royalblue-navy-forestgreen'
-            elif self.colours.startswith('top'):
+            if self.colours.startswith('top'):
                 keys = self.__top_colours__(self.colours, rgb)
             else:
-                keys = self.colours
+                keys = self.preset_colours(self.colours)
 
-            rgb_keys = []
-            for key in keys.split('-'):
-                rgb_keys.append(self.key_to_rgb_key(key, rgb))
-            self.rgb = {key : rgb[key] for key in sorted(rgb_keys)}
+            rgb_keys = self.keys_to_rgb_keys(keys.split('-'), rgb, self.metric)
+            return sorted(set(rgb_keys))
 
     def __top_colours__(self, colours, rgb):
         assert colours.startswith('top')
-        keys = ''
         use_image = colours.endswith('image')
         value = int(colours.replace('top', '').replace('image', ''))
-        K = []
-        T = []
-        X = []
-        for key, colour in rgb.items():
-            K.append(key)
-            T.append(colour)
-        K = np.array(K)
-        T = np.stack(T)
         if use_image:
             X = np.reshape(self.rim, (-1, RGB_DIM))
         else:
-            X = T.copy()
-        clusters = KMeans(n_clusters=value, **KMEANS_PARAMS).fit_predict(X)
-        for v in range(value):
-            C = np.mean(X[clusters==v,:], axis=0, keepdims=True)
-            key = K[np.argmin(np.mean(np.abs(T - C), axis=-1))]
-            keys += f'{key}-'
-        return keys[:-1]
+            X = np.array(list(rgb.values()))
+        C = extract_palette(X, value, self.palette_method)
+        keys = palette_index(rgb, power=1, metric=self.metric).nearest_keys(C)
+        return '-'.join(keys)
 
     @staticmethod
-    def key_to_rgb_key(key, rgb):
-        if key.isdigit():
-            assert key in rgb
-            return key
-        else:
-            key_colour = np.array(to_rgb(key))
-            best_key = '000'
-            best_dist = 1
-            for rgb_key, rgb_colour in rgb.items():
-                dist = np.mean((key_colour - np.array(rgb_colour))**2)
-                if dist < best_dist:
-                    best_key = rgb_key
-                    best_dist = dist
-            return best_key
+    def keys_to_rgb_keys(keys, rgb, metric='rgb'):
+        names = [key for key in keys if not key.isdigit()]
+        if names:
+            from matplotlib.colors import to_rgb
+            nearest = palette_index(rgb, power=2, metric=metric).nearest_keys([to_rgb(name) for name in names])
+            nearest = dict(zip(names, nearest))
+        rgb_keys = []
+        for key in keys:
+            if key.isdigit():
+                assert key in rgb
+                rgb_keys.append(key)
+            else:
+                rgb_keys.append(str(nearest[key]))
+        return rgb_keys
+
+    @staticmethod
+    def key_to_rgb_key(key, rgb, metric='rgb'):
+        return PixelInit.keys_to_rgb_keys([key], rgb, metric)[0]
 
     def __pixelsize__(self, pixelsize):
-        assert pixelsize.count('x') <= 1
         self.pixelsize = pixelsize
-        if 'x' not in self.pixelsize:
-            self.xps = int(self.pixelsize)
-            self.yps = int(self.pixelsize)
-        else:
-            self.yps, self.xps = self.pixelsize.split('x')
-            self.xps = int(self.xps)
-            self.yps = int(self.yps)
+        self.yps, self.xps = self.split_size(self.pixelsize)
         assert (self.nx % self.xps) == 0
         assert (self.ny % self.yps) == 0
 
@@ -197,4 +259,4 @@ class PixelInit(object):
         return s
 
     def timer(self):
-        return self.time_to_string(time() - self.start_time)
\ No newline at end of file
+        return self.time_to_string(self.profiler.elapsed())
\ No newline at end of file
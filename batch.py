@@ -0,0 +1,153 @@
+import os
+import os.path as osp
+import io
+import json
+import glob
+import multiprocessing
+from argparse import Namespace
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+from config import *
+from main import get_parser, ParameterParser
+
+
+def list_jobs(images, kwargs):
+    '''
+    List the images to pixelize with their parameters.
+    The images can be a folder, a glob pattern, or a json manifest holding either a list of
+    objects with an 'image' and its parameters, or a dictionary from images to their parameters.
+    The parameters of the manifest are checked as on the command line,
+    the error of invalid ones being kept to be reported by the job.
+    '''
+    if osp.isdir(images):
+        files = sorted(
+            osp.join(images, file) for file in os.listdir(images)
+            if osp.splitext(file)[1].lower() in BATCH_EXTENSIONS
+        )
+        return [(file, kwargs.copy()) for file in files]
+    elif images.endswith('.json'):
+        folder = osp.dirname(images)
+        with open(images, 'r') as m:
+            manifest = json.load(m)
+        if isinstance(manifest, dict):
+            manifest = [{'image' : image, **overrides} for image, overrides in manifest.items()]
+        parser = get_parser(ParameterParser())
+        jobs = []
+        for overrides in manifest:
+            overrides = overrides.copy()
+            image = osp.join(folder, overrides.pop('image'))
+            argv = []
+            for key, value in overrides.items():
+                argv += [f'--{key}', str(value)]
+            try:
+                parameters = vars(parser.parse_args(argv, namespace=Namespace(**kwargs)))
+                parameters.pop('image')
+            except ValueError as e:
+                parameters = {**kwargs, **overrides, 'invalid' : str(e)}
+            jobs.append((image, parameters))
+        return jobs
+    else:
+        return [(file, kwargs.copy()) for file in sorted(glob.glob(images))]
+
+
+def warm_up(jobs):
+    '''
+    Import the pipeline and load the plate colours and the colour options shared by the jobs
+    before starting the workers, which inherit them when forked.
+    The palettes extracted with k-means are left to the workers,
+    as well as the jobs failing here, which report their error when they run.
+    '''
+    from __init__ import PixelInit
+    from palette import load_rgb
+    from matcher import colour_options
+    rgb = load_rgb()
+    for _, kwargs in jobs:
+        colours = kwargs['colours']
+        if 'invalid' in kwargs or colours.startswith('top') or kwargs['search'] != 'brute':
+            continue
+        try:
+            if colours == 'all':
+                palette = rgb
+            else:
+                keys = PixelInit.keys_to_rgb_keys(PixelInit.preset_colours(colours).split('-'), rgb, kwargs['metric'])
+                palette = {key : rgb[key] for key in sorted(set(keys))}
+            yps, xps = PixelInit.split_size(kwargs['pixelsize'])
+        except Exception:
+            continue
+        if xps*yps > 1:
+            colour_options(palette, xps, yps)
+
+
+def run_job(job):
+    from pixel import Pixel
+    image, kwargs = job
+    start = time()
+    summary = {'image' : image, 'parameters' : kwargs}
+    try:
+        if 'invalid' in kwargs:
+            raise ValueError(kwargs['invalid'])
+        with redirect_stdout(io.StringIO()):
+            pixel = Pixel(image=image, **kwargs)
+        summary['output'] = pixel.save_dir
+        summary['colours'] = len(pixel.rgb)
+        summary['palette'] = list(pixel.rgb)
+        summary['stages'] = {name : stage['wall'] for name, stage in pixel.profiler.stages.items()}
+        if not pixel.draft:
+            summary['plates'] = sum(infos['plates'] for infos in pixel.plates.values())
+            summary['pixels'] = {col : infos['pixels'] for col, infos in pixel.plates.items()}
+    except Exception as e:
+        summary['error'] = repr(e)
+    summary['time'] = time() - start
+    return summary
+
+
+def map_jobs(func, job_list, jobs=1):
+    '''
+    Run func on each job in order, on a pool of forked processes if jobs is not 1 (0 using all cores),
+    the pipeline being warmed up for the jobs beforehand. Yields the result of each job.
+    '''
+    warm_up(job_list)
+    if jobs == 1:
+        yield from map(func, job_list)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=jobs or None,
+            mp_context=multiprocessing.get_context('fork'),
+        ) as executor:
+            yield from executor.map(func, job_list)
+
+
+def batch(images, jobs=1, summary=BATCH_SUMMARY, **kwargs):
+    start = time()
+    job_list = list_jobs(images, kwargs)
+    print(f'{len(job_list)} images to pixelize')
+    results = []
+    for index, result in enumerate(map_jobs(run_job, job_list, jobs)):
+        results.append(result)
+        status = result.get('error', f'{result["time"]:.1f}s')
+        print(f'{index + 1} of {len(job_list)}: {result["image"]} ({status})')
+    with open(summary, 'w') as s:
+        json.dump({
+            'time' : time() - start,
+            'images' : results,
+            'plates' : sum(result.get('plates', 0) for result in results),
+        }, s, indent=2)
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--images', type=str, required=True,
+        help='''
+        The images to pixelize, either a folder, a glob pattern, or a json manifest.
+        The manifest is a list of objects with an 'image' and the parameters to override for it,
+        for example [{"image": "cat.jpg", "dimension": "2"}], the image paths being relative to the manifest.
+        ''')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='The number of images processed at the same time, 0 using all cores.')
+    parser.add_argument('--summary', type=str, default=BATCH_SUMMARY,
+        help='The json file summarizing the timings and plates of each image.')
+    kwargs = vars(parser.parse_args())
+    kwargs.pop('image')
+    batch(**kwargs)
@@ -0,0 +1,434 @@
+import os.path as osp
+import sys
+import argparse
+import json
+import tempfile
+import multiprocessing
+import subprocess
+import numpy as np
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+from config import *
+from reducer import block_mean, area_mean
+from matcher import to_blocks, colour_options, match_blocks
+from search import search_blocks
+from palette import palette_index, extract_palette, palette_error
+from colourspace import convert, convert_palette
+
+
+def synthetic_image(imx, imy, seed=27):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, imx)[:,None,None]
+    y = np.linspace(0, 1, imy)[None,:,None]
+    phase = rng.random((1, 1, RGB_DIM))
+    im = 0.5 + 0.4*np.sin(2*np.pi*(x + 2*y + phase))
+    im = im + 0.1*rng.random((imx, imy, RGB_DIM))
+    return np.clip(im, 0, 1)
+
+
+def loop_mean(im, nx, ny, mult, dx=0, dy=0):
+    rim = np.zeros((nx, ny, RGB_DIM))
+    for i in range(nx):
+        for j in range(ny):
+            rim[i,j,:] = np.mean(np.mean(
+                im[
+                    dx + mult*i:dx + mult + mult*i,
+                    dy + mult*j:dy + mult + mult*j,
+                :],
+            axis=0), axis=0)
+    return rim
+
+
+def timeit(func, *args, repeat=1, **kwargs):
+    best = np.inf
+    for _ in range(repeat):
+        start = time()
+        output = func(*args, **kwargs)
+        best = min(best, time() - start)
+    return best, output
+
+
+def synthetic_rim(dimension):
+    nx = PIXELPLATE_SIZE[0]*dimension
+    ny = PIXELPLATE_SIZE[1]*dimension
+    return block_mean(synthetic_image(4*nx, 4*ny), nx, ny, 4)
+
+
+def sample_palette(size):
+    with open(RGB_DICT, 'r') as d:
+        rgb = json.load(d)
+    keys = sorted(rgb)
+    keys = [keys[int(i)] for i in np.linspace(0, len(keys) - 1, size)]
+    return {key : rgb[key] for key in keys}
+
+
+def pattern_score(rim, pim, xps, yps):
+    blocks = to_blocks(rim, xps, yps)
+    colours = to_blocks(pim, xps, yps)
+    cells = np.mean(np.mean(np.abs(blocks - colours)**DIST_POWER, axis=-1)**(1/DIST_POWER), axis=(1, 2))
+    means = np.mean(blocks, axis=(1, 2)) - np.mean(colours, axis=(1, 2))
+    means = np.mean(np.abs(means)**DIST_POWER, axis=-1)**(1/DIST_POWER)
+    return np.mean(cells), np.mean(means)
+
+
+def bench_reducer(megapixels, dimension, repeat, loop):
+    nx = PIXELPLATE_SIZE[0]*dimension
+    ny = PIXELPLATE_SIZE[1]*dimension
+    print(f'Setup time for a {nx}x{ny} grid (dimension {dimension})')
+    print(f'{"image":>12}{"loop":>10}{"block":>10}{"area":>10}')
+    for mp in megapixels:
+        imy = int(np.sqrt(1e6*mp*PIXELPLATE_SIZE[1]/PIXELPLATE_SIZE[0]))
+        imx = int(1e6*mp/imy)
+        im = synthetic_image(imx, imy)
+        mult = min(int(imx/nx), int(imy/ny))
+        row = f'{f"{imx}x{imy}":>12}'
+        if loop:
+            row += f'{timeit(loop_mean, im, nx, ny, mult, repeat=repeat)[0]:>9.3f}s'
+        else:
+            row += f'{"-":>10}'
+        row += f'{timeit(block_mean, im, nx, ny, mult, repeat=repeat)[0]:>9.3f}s'
+        row += f'{timeit(area_mean, im, nx, ny, repeat=repeat)[0]:>9.3f}s'
+        print(row)
+
+
+def brute_search(rim, rgb, xps, yps):
+    option = colour_options(rgb, xps, yps)
+    return match_blocks(rim, list(rgb.values()), option)
+
+
+def bench_search(palettes, pixelsizes, dimension, repeat):
+    rim = synthetic_rim(dimension)
+    print(f'Pattern search on a {np.size(rim, axis=0)}x{np.size(rim, axis=1)} grid (dimension {dimension})')
+    print('The scores are the mean cell distance and the mean colour distance of the patterns.')
+    print(f'{"colours":>8}{"size":>6}{"search":>10}{"time":>10}{"cells":>10}{"means":>10}{"agree":>8}')
+    for size in palettes:
+        rgb = sample_palette(size)
+        for pixelsize in pixelsizes:
+            xps, yps = pixelsize
+            searches = {
+                'brute' : lambda: brute_search(rim, rgb, xps, yps),
+                'exact' : lambda: search_blocks(rim, list(rgb.values()), xps, yps, exact=True),
+                'greedy' : lambda: search_blocks(rim, list(rgb.values()), xps, yps, exact=False),
+            }
+            reference = None
+            for search, func in searches.items():
+                t, iim = timeit(func, repeat=repeat)
+                if reference is None:
+                    reference = iim
+                cells, means = pattern_score(rim, np.array(list(rgb.values()))[iim], xps, yps)
+                agree = np.mean(iim == reference)
+                print(f'{size:>8}{f"{xps}x{yps}":>6}{search:>10}{t:>9.3f}s{cells:>10.5f}{means:>10.5f}{agree:>8.1%}')
+
+
+def bench_metric(palettes, pixelsizes, dimension, repeat):
+    rim = synthetic_rim(dimension)
+    npix = np.size(rim, axis=0)*np.size(rim, axis=1)
+    print(f'Matching in each colour space on a {np.size(rim, axis=0)}x{np.size(rim, axis=1)} grid (dimension {dimension})')
+    print('The total includes the conversion of the image, and the agreement is with the RGB matching.')
+    print(f'{"colours":>8}{"size":>6}{"metric":>8}{"convert":>10}{"total":>10}{"Mpix/s":>10}{"agree":>8}')
+    for size in palettes:
+        rgb = sample_palette(size)
+        for pixelsize in pixelsizes:
+            xps, yps = pixelsize
+            reference = None
+            for metric in ['rgb', 'lab', 'oklab']:
+                t_convert, X = timeit(convert, rim, metric, repeat=repeat)
+                if xps*yps == 1:
+                    index = palette_index(rgb, metric=metric)
+                    t, iim = timeit(index.query, rim, repeat=repeat)
+                else:
+                    palette = convert_palette(rgb, metric)
+                    option = colour_options(rgb, xps, yps)
+                    t, iim = timeit(match_blocks, X, palette, option, repeat=repeat)
+                    t += t_convert
+                if reference is None:
+                    reference = iim
+                agree = np.mean(iim == reference)
+                print(f'{size:>8}{f"{xps}x{yps}":>6}{metric:>8}{t_convert:>9.3f}s{t:>9.3f}s{npix/t/1e6:>10.2f}{agree:>8.1%}')
+
+
+def image_rim(image, dimension):
+    from PIL import Image
+    im = np.asarray(Image.open(image).convert('RGB'))/RGB_MAX_INT
+    nx = PIXELPLATE_SIZE[0]*dimension
+    ny = PIXELPLATE_SIZE[1]*dimension
+    return area_mean(im, nx, ny)
+
+
+def bench_palette(sizes, dimension, repeat, image=None):
+    if image is None:
+        rim = synthetic_rim(dimension)
+    else:
+        rim = image_rim(image, dimension)
+    X = np.reshape(rim, (-1, RGB_DIM))
+    with open(RGB_DICT, 'r') as d:
+        rgb = json.load(d)
+    plates = palette_index(rgb, power=1)
+    print(f'Palette extraction on {len(X)} pixels')
+    print('The errors are the mean distance of the pixels to the extracted colours and to the chosen plates.')
+    print(f'{"colours":>8}{"method":>11}{"time":>10}{"colours":>10}{"plates":>10}')
+    for size in sizes:
+        for method in ['kmeans', 'minibatch', 'histogram', 'mediancut']:
+            t, colours = timeit(extract_palette, X, size, method, repeat=repeat)
+            plate_colours = np.unique(plates.nearest_colours(colours), axis=0)
+            print(f'{size:>8}{method:>11}{t:>9.3f}s{palette_error(X, colours):>10.5f}{palette_error(X, plate_colours):>10.5f}')
+
+
+STARTUP_DRAFT = '''
+import sys
+from pixel import Pixel
+Pixel(image=sys.argv[1], orientation='default', halign='center', valign='center', dimension='1',
+      colours='basic', pixelsize='1', draft=1, dpi=1, backend='raster', no_cache=1)
+print(' '.join(module for module in ['matplotlib', 'sklearn'] if module in sys.modules), file=sys.stderr)
+'''
+
+
+def bench_startup(repeat):
+    '''
+    Time fresh interpreters running the command line help, a rejected argument, the import of the pipeline,
+    and a small draft job, listing the heavy modules imported by the draft job.
+    '''
+    folder = osp.dirname(osp.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        image = osp.join(tmp, 'startup.png')
+        imx = PIXELPLATE_SIZE[0]*BENCH_CELL_PIXELS
+        imy = PIXELPLATE_SIZE[1]*BENCH_CELL_PIXELS
+        Image.fromarray((RGB_MAX_INT*synthetic_image(imx, imy)).astype(np.uint8)).save(image)
+        commands = {
+            'help' : ['main.py', '--help'],
+            'invalid' : ['main.py', '--search', 'none'],
+            'import' : ['-c', 'import pixel'],
+            'draft' : ['-c', STARTUP_DRAFT, image],
+        }
+        print(f'{"command":>10}{"time":>10}  imported')
+        for name, command in commands.items():
+            best = np.inf
+            for _ in range(repeat):
+                start = time()
+                run = subprocess.run([sys.executable] + command, cwd=folder, capture_output=True, text=True)
+                best = min(best, time() - start)
+            imported = run.stderr.strip() if name == 'draft' else ''
+            print(f'{name:>10}{best:>9.3f}s  {imported}')
+
+
+def suite_configs(dimensions, colours, pixelsizes):
+    with open(RGB_DICT, 'r') as d:
+        ncolours = len(json.load(d))
+    configs = []
+    for dimension in dimensions:
+        for palette in colours:
+            for pixelsize in pixelsizes:
+                if palette == 'all':
+                    size = ncolours
+                elif palette.startswith('top'):
+                    size = int(palette.replace('top', '').replace('image', ''))
+                else:
+                    size = len(palette.split('-'))
+                ncells = np.prod([int(ps) for ps in pixelsize.split('x')])
+                search = 'brute' if size**ncells <= BENCH_MAX_OPTIONS else 'multiset'
+                configs.append({
+                    'name' : f'{dimension}:{palette}:{pixelsize}',
+                    'dimension' : str(dimension),
+                    'colours' : palette,
+                    'pixelsize' : pixelsize,
+                    'search' : search,
+                    'exact' : 0,
+                })
+    return configs
+
+
+def run_config(config, folder, draft, dpi, backend):
+    from pixel import Pixel
+    from io import StringIO
+    from contextlib import redirect_stdout
+    dimension = int(config['dimension'])
+    image = osp.join(folder, f'synthetic{dimension}.png')
+    if not osp.exists(image):
+        imx = PIXELPLATE_SIZE[0]*dimension*BENCH_CELL_PIXELS
+        imy = PIXELPLATE_SIZE[1]*dimension*BENCH_CELL_PIXELS
+        Image.fromarray((RGB_MAX_INT*synthetic_image(imx, imy)).astype(np.uint8)).save(image)
+    kwargs = {key : value for key, value in config.items() if key != 'name'}
+    with redirect_stdout(StringIO()):
+        pixel = Pixel(
+            image=image,
+            orientation='default',
+            halign='center',
+            valign='center',
+            draft=draft,
+            dpi=dpi,
+            backend=backend,
+            no_cache=1,
+            **kwargs,
+        )
+    return pixel.profiler.to_dict()
+
+
+def best_result(runs):
+    '''
+    Combine the repeated runs of a configuration, keeping the best time and memory of each stage,
+    and the spread of its times as the noise of the measure.
+    '''
+    def best(stages):
+        walls = [stage['wall'] for stage in stages]
+        rss = [stage['peak_rss'] for stage in stages if stage['peak_rss'] is not None]
+        return {
+            **stages[0],
+            'wall' : min(walls),
+            'cpu' : min(stage['cpu'] for stage in stages),
+            'peak_rss' : min(rss) if rss else None,
+            'noise' : max(walls) - min(walls),
+        }
+    return {
+        'total' : best([run['total'] for run in runs]),
+        'stages' : {
+            name : best([run['stages'][name] for run in runs if name in run['stages']])
+            for name in runs[0]['stages']
+        },
+        'counters' : runs[0]['counters'],
+        'repeat' : len(runs),
+    }
+
+
+def compare(results, baseline, threshold):
+    '''
+    List the stages slower or using more memory than in the baseline by more than the threshold ratio,
+    the memory of a stage being how much it raised the peak memory of the run.
+    Differences under BENCH_MIN_TIME seconds, BENCH_MIN_MEMORY megabytes,
+    or the sum of the time noises of the repeated runs of both sides are ignored.
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        stages = {'total' : result['total'], **result['stages']}
+        base_stages = {'total' : baseline[name]['total'], **baseline[name]['stages']}
+        for stage, values in stages.items():
+            if stage not in base_stages:
+                continue
+            base = base_stages[stage]
+            noise = values.get('noise', 0.) + base.get('noise', 0.)
+            if values['wall'] - base['wall'] > max(threshold*base['wall'], BENCH_MIN_TIME, noise):
+                regressions.append(f'{name} {stage}: {base["wall"]:.3f}s -> {values["wall"]:.3f}s')
+            if None not in [values['peak_rss'], base['peak_rss']]:
+                if values['peak_rss'] - base['peak_rss'] > max(threshold*base['peak_rss'], BENCH_MIN_MEMORY):
+                    regressions.append(f'{name} {stage}: {base["peak_rss"]:.0f}MB -> {values["peak_rss"]:.0f}MB')
+    return regressions
+
+
+def bench_suite(dimensions, colours, pixelsizes, draft, dpi, backend, output=None, baseline=None, threshold=0.2, repeat=3):
+    '''
+    Run the whole pipeline on synthetic images for each combination of dimension, colours and pixel size.
+    Each configuration is run repeat times, each run in a fresh process so that its peak memory is its own,
+    and the best time and memory of the runs are kept.
+    The results can be saved and compared to a baseline, failing on regressions.
+    '''
+    configs = suite_configs(dimensions, colours, pixelsizes)
+    results = {}
+    print(f'{"config":>20}{"search":>10}{"total":>10}{"memory":>10}  stages')
+    with tempfile.TemporaryDirectory() as folder:
+        for config in configs:
+            runs = []
+            for _ in range(repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    runs.append(executor.submit(run_config, config, folder, draft, dpi, backend).result())
+            result = best_result(runs)
+            results[config['name']] = result
+            stages = ' '.join(f'{stage}={values["wall"]:.2f}s' for stage, values in result['stages'].items())
+            print(f'{config["name"]:>20}{config["search"]:>10}{result["total"]["wall"]:>9.2f}s{result["total"]["peak_rss"]:>8.0f}MB  {stages}')
+    if output is not None:
+        with open(output, 'w') as o:
+            json.dump(results, o, indent=2)
+    if baseline is not None:
+        with open(baseline, 'r') as b:
+            regressions = compare(results, json.load(b), threshold)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regression against {baseline}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', type=str, default='reducer',
+        help='The benchmark to run, either \'reducer\', \'search\', \'metric\', \'palette\', \'startup\', or \'suite\'.')
+    parser.add_argument('--image', type=str, default=None,
+        help='The image used for the palette benchmark, a synthetic image being used by default.')
+    parser.add_argument('--megapixels', type=str, default='1-5-20',
+        help='The image sizes to benchmark, in megapixels, separated by \'-\'.')
+    parser.add_argument('--dimension', type=int, default=10,
+        help='The number of plates on each side of the grid.')
+    parser.add_argument('--palettes', type=str, default='4-7-12',
+        help='The palette sizes to benchmark, separated by \'-\'.')
+    parser.add_argument('--tops', type=str, default='10-20',
+        help='The numbers of extracted colours to benchmark, separated by \'-\'.')
+    parser.add_argument('--pixelsizes', type=str, default=None,
+        help='The pixel sizes to benchmark, separated by \'-\' (\'1x2-2x2\' for search, \'1-1x2-2x2\' for metric and the suite).')
+    parser.add_argument('--dimensions', type=str, default='1-2-5-10',
+        help='The dimensions of the suite, separated by \'-\'.')
+    parser.add_argument('--colours', type=str, default='basic,top20,all',
+        help='The colours of the suite, separated by \',\'.')
+    parser.add_argument('--draft', type=int, default=1,
+        help='Whether the suite only runs the draft stages.')
+    parser.add_argument('--dpi', type=int, default=2,
+        help='The dpi of the images rendered by the suite.')
+    parser.add_argument('--backend', type=str, default='matplotlib',
+        help='The backend rendering the images of the suite.')
+    parser.add_argument('--output', type=str, default=None,
+        help='The json file to save the results of the suite to.')
+    parser.add_argument('--baseline', type=str, default=None,
+        help='A json file of previous results of the suite, the run failing on regressions.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+        help='The ratio of time or memory above the baseline counted as a regression.')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='The number of repetitions, the best time being reported.')
+    parser.add_argument('--loop', type=int, default=1,
+        help='Whether to also time the reference per-cell loop.')
+    kwargs = vars(parser.parse_args())
+    if kwargs['bench'] == 'reducer':
+        bench_reducer(
+            megapixels=[float(mp) for mp in kwargs['megapixels'].split('-')],
+            dimension=kwargs['dimension'],
+            repeat=kwargs['repeat'],
+            loop=kwargs['loop'],
+        )
+    elif kwargs['bench'] == 'search':
+        bench_search(
+            palettes=[int(size) for size in kwargs['palettes'].split('-')],
+            pixelsizes=[tuple(map(int, ps.split('x'))) for ps in (kwargs['pixelsizes'] or '1x2-2x2').split('-')],
+            dimension=kwargs['dimension'],
+            repeat=kwargs['repeat'],
+        )
+    elif kwargs['bench'] == 'metric':
+        bench_metric(
+            palettes=[int(size) for size in kwargs['palettes'].split('-')],
+            pixelsizes=[(int(ps.split('x')[0]), int(ps.split('x')[-1])) for ps in (kwargs['pixelsizes'] or '1-1x2-2x2').split('-')],
+            dimension=kwargs['dimension'],
+            repeat=kwargs['repeat'],
+        )
+    elif kwargs['bench'] == 'palette':
+        bench_palette(
+            sizes=[int(size) for size in kwargs['tops'].split('-')],
+            dimension=kwargs['dimension'],
+            repeat=kwargs['repeat'],
+            image=kwargs['image'],
+        )
+    elif kwargs['bench'] == 'startup':
+        bench_startup(repeat=kwargs['repeat'])
+    elif kwargs['bench'] == 'suite':
+        bench_suite(
+            dimensions=[int(dimension) for dimension in kwargs['dimensions'].split('-')],
+            colours=kwargs['colours'].split(','),
+            pixelsizes=(kwargs['pixelsizes'] or '1-1x2-2x2').split('-'),
+            draft=kwargs['draft'],
+            dpi=kwargs['dpi'],
+            backend=kwargs['backend'],
+            output=kwargs['output'],
+            baseline=kwargs['baseline'],
+            threshold=kwargs['threshold'],
+            repeat=kwargs['repeat'],
+        )
+    else:
+        raise ValueError(f'unknown benchmark {kwargs["bench"]!r}, expected one of reducer, search, metric, palette, startup, suite')
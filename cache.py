@@ -0,0 +1,153 @@
+import os
+import os.path as osp
+import json
+import shutil
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+from config import *
+
+
+def file_hash(file):
+    h = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(CACHE_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def fingerprint(*parts):
+    '''
+    Hash a sequence of arrays and json-serializable objects.
+    '''
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(f'{part.dtype}{part.shape}'.encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(json.dumps(part, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:CACHE_KEY_LENGTH]
+
+
+class ResultCache(object):
+    '''
+    On-disk cache of the arrays computed at each stage, keyed on the stage and its parameters.
+    Each entry is a folder of .npy files, loaded as memory maps.
+    The least recently used entries are evicted once the cache exceeds max_size megabytes.
+    '''
+
+    def __init__(self, folder=CACHE_FOLDER, max_size=CACHE_SIZE):
+        self.folder = folder
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(stage, params):
+        s = json.dumps([stage, params], sort_keys=True, default=str)
+        return hashlib.sha256(s.encode()).hexdigest()[:CACHE_KEY_LENGTH]
+
+    def entry(self, stage, key):
+        return osp.join(self.folder, f'{stage}-{key}')
+
+    def load(self, stage, key):
+        '''
+        Load the arrays of an entry, an entry removed meanwhile by another process being a miss.
+        '''
+        entry = self.entry(stage, key)
+        try:
+            os.utime(entry)
+            return {
+                osp.splitext(file)[0] : np.load(osp.join(entry, file), mmap_mode='r')
+                for file in sorted(os.listdir(entry))
+            }
+        except FileNotFoundError:
+            return None
+
+    def save(self, stage, key, arrays):
+        entry = self.entry(stage, key)
+        tmp = f'{entry}.{os.getpid()}.tmp'
+        os.makedirs(tmp, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(osp.join(tmp, f'{name}.npy'), np.asarray(array))
+        try:
+            os.replace(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    @staticmethod
+    def stat(entry):
+        '''
+        Modification time and size of an entry, or None if another process removed it.
+        '''
+        try:
+            mtime = osp.getmtime(entry)
+            return mtime, sum(
+                osp.getsize(osp.join(entry, file))
+                for file in os.listdir(entry)
+            )
+        except FileNotFoundError:
+            return None
+
+    def evict(self):
+        '''
+        Remove the least recently used entries, each being renamed first so that other processes
+        either load it whole or miss it.
+        '''
+        entries = [
+            (entry, self.stat(entry))
+            for entry in [osp.join(self.folder, entry) for entry in os.listdir(self.folder)]
+            if not entry.endswith('.tmp')
+        ]
+        entries = sorted([(stat, entry) for entry, stat in entries if stat is not None])
+        total = sum(size for (_, size), _ in entries)
+        for (_, size), entry in entries:
+            if total <= self.max_size*2**20:
+                break
+            total -= size
+            tmp = f'{entry}.{os.getpid()}.evict.tmp'
+            try:
+                os.rename(entry, tmp)
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def cached(self, stage, params, compute):
+        '''
+        Return the arrays of a stage, only running compute if they are not in the cache.
+        Also returns the key of the stage, to be used in the parameters of the stages depending on it.
+        '''
+        key = self.key(stage, params)
+        arrays = self.load(stage, key)
+        if arrays is None:
+            self.misses += 1
+            arrays = compute()
+            self.save(stage, key, arrays)
+        else:
+            self.hits += 1
+        return arrays, key
+
+
+class MemoryCache(object):
+    '''
+    In-memory cache of the objects reused by the next images, keeping the max_entries most recently used.
+    '''
+
+    def __init__(self, max_entries=MEMORY_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, compute):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        else:
+            self.entries[key] = compute()
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return self.entries[key]
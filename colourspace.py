@@ -0,0 +1,71 @@
+import numpy as np
+
+from config import *
+from cache import MemoryCache
+
+
+SRGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+SRGB_TO_LMS = np.array([
+    [0.4122214708, 0.5363325363, 0.0514459929],
+    [0.2119034982, 0.6806995451, 0.1073969566],
+    [0.0883024619, 0.2817188376, 0.6299787005],
+])
+LMS_TO_OKLAB = np.array([
+    [0.2104542553, 0.7936177850, -0.0040720468],
+    [1.9779984951, -2.4285922050, 0.4505937099],
+    [0.0259040371, 0.7827717662, -0.8086757660],
+])
+
+
+def srgb_to_linear(X):
+    X = np.asarray(X, dtype=float)
+    return np.where(X <= 0.04045, X/12.92, ((np.maximum(X, 0.04045) + 0.055)/1.055)**2.4)
+
+
+def rgb_to_lab(X):
+    '''
+    Convert sRGB colours in [0, 1] to CIELAB under D65, divided by LAB_SCALE.
+    '''
+    T = (srgb_to_linear(X) @ SRGB_TO_XYZ.T)/np.array(LAB_WHITE)
+    delta = 6/29
+    F = np.where(T > delta**3, np.cbrt(T), T/(3*delta**2) + 4/29)
+    L = 116*F[...,1] - 16
+    a = 500*(F[...,0] - F[...,1])
+    b = 200*(F[...,1] - F[...,2])
+    return np.stack([L, a, b], axis=-1)/LAB_SCALE
+
+
+def rgb_to_oklab(X):
+    '''
+    Convert sRGB colours in [0, 1] to OKLab.
+    '''
+    return np.cbrt(srgb_to_linear(X) @ SRGB_TO_LMS.T) @ LMS_TO_OKLAB.T
+
+
+def convert(X, metric='rgb'):
+    '''
+    Convert an array of sRGB colours of shape (..., RGB_DIM) to the colour space of the metric, in a single pass.
+    '''
+    if metric == 'lab':
+        return rgb_to_lab(X)
+    elif metric == 'oklab':
+        return rgb_to_oklab(X)
+    else:
+        assert metric == 'rgb'
+        return np.asarray(X, dtype=float)
+
+
+CONVERTED_PALETTES = MemoryCache()
+
+def convert_palette(rgb, metric='rgb'):
+    '''
+    Convert the colours of a palette to the colour space of the metric.
+    The last conversions are kept in memory to be reused by the next images with the same palette.
+    '''
+    colours = np.array(list(rgb.values()), dtype=float)
+    key = (tuple(rgb), colours.tobytes(), metric)
+    return CONVERTED_PALETTES.get(key, lambda: convert(colours, metric))
@@ -2,17 +2,51 @@ RGB_MAX_INT = 255
 RGB_DIM = 3
 
 RGB_DICT = 'rgb.json'
+RGB_BINARY = 'rgb.npz' # written by data/process.py, loaded instead of RGB_DICT when newer
 PIXELPLATE_SIZE = (50, 40)
 PIXELS_PER_SQUARE = 6*6*4 - 4 # = 140
 PLATE_RATIO = 634/1000
 
+STRIP_ROWS = 256
 DIST_POWER = 2
+NEAREST_BRUTE_COLOURS = 16 # larger palettes are searched with a KD-tree for more than NEAREST_BRUTE_POINTS colours
+NEAREST_BRUTE_POINTS = 1024
+NEAREST_CHUNK = 2**18 # number of colour distances computed at once
+MATCH_MEMORY = 256 # in megabytes
+MATCH_MEMORY_FACTOR = 4 # number of option-sized arrays per block while matching
+SEARCH_TOLERANCE = 1e-12
+SEARCH_ROUNDS = 10
+SEARCH_MAX_PERMUTATIONS = 720
+BAYER_SIZE = 4 # side of the ordered dithering matrix, a power of 2
+DITHER_SPREAD = 0.5 # amplitude of the ordered dithering, relative to the spacing of the palette
+FLOYD_STEINBERG = (
+    (0, 1, 7/16),
+    (1, -1, 3/16),
+    (1, 0, 5/16),
+    (1, 1, 1/16),
+)
+LAB_WHITE = (0.95047, 1., 1.08883) # D65 reference white
+LAB_SCALE = 100 # CIELAB is divided by its lightness range to compare with the other metrics
 KMEANS_PARAMS = {
     'n_init' : 100,
     'max_iter'  : 1000,
     'tol'  : 1e-5,
     'random_state' : 27,
 }
+MINIBATCH_KMEANS_PARAMS = {
+    'n_init' : 3,
+    'batch_size' : 4096,
+    'max_iter' : 100,
+    'random_state' : 27,
+}
+HISTOGRAM_BITS = 5
+HISTOGRAM_KMEANS_PARAMS = {
+    'n_init' : 10,
+    'max_iter' : 300,
+    'tol'  : 1e-5,
+    'random_state' : 27,
+}
+MPL_BACKEND = 'Agg'
 GRID_PARAMS = {
     'color' : 'gray',
     'lw' : 5,
@@ -36,13 +70,56 @@ PLATE_COLOUR_PARAMS = {
     'height' : COLOUR_SIDE,
     'lw' : 0,
 }
+POINTS_PER_INCH = 72
+RASTER_GRID_COLOUR = (128, 128, 128)
+RASTER_TEXT_COLOUR = (128, 128, 128)
+PNG_COMPRESSION = 6 # zlib level from 0 (fastest) to 9 (smallest)
+WRITER_THREADS = 2
+WRITER_BUFFER = 8 # images drawn but not yet written
 NIM_THRESHOLD = 0.2
 NIM_RATIO = 0.8
 
+BENCH_CELL_PIXELS = 8
+BENCH_MAX_OPTIONS = 10000
+BENCH_MIN_TIME = 0.05 # in seconds
+BENCH_MIN_MEMORY = 20 # in megabytes
+
+CACHE_FOLDER = 'cache'
+CACHE_SIZE = 1024 # in megabytes
+CACHE_KEY_LENGTH = 32
+CACHE_BLOCK_SIZE = 2**20
+MEMORY_CACHE_ENTRIES = 8 # palettes, indices and colour options kept in memory
+
+BATCH_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+BATCH_SUMMARY = 'summary.json'
+
+INVENTORY_FOLDER = 'inventory'
+PURCHASE_FILE = 'purchase.txt'
+LEFTOVERS_FILE = 'leftovers.txt'
+SUBSTITUTIONS_FILE = 'substitutions.json'
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8427
+SERVER_QUEUE = 8 # jobs waiting or running before new requests are refused
+SERVER_MAX_UPLOAD = 64 # in megabytes
+SERVER_PARAMETERS = [ # parameters a request can set, the others keeping the defaults of the server
+    'orientation', 'halign', 'valign', 'dimension', 'resample', 'colours', 'palette_method',
+    'pixelsize', 'metric', 'search', 'exact', 'dither', 'backend',
+]
+SERVER_TYPES = {
+    'image/jpeg' : '.jpg',
+    'image/png' : '.png',
+    'application/octet-stream' : '.npy',
+}
+
 OUTPUT_FOLDER = 'output:'
 IMAGE_FILE = 'image.png'
 PLATES_INFO = 'plates.json'
 PLATES_FILE = 'plates.txt'
 PIXEL_FILE = 'pixels.txt'
+MANIFEST_FILE = 'manifest.json'
+PROFILE_FILE = 'profile.json'
+PROFILE_STATS = 'profile.prof'
+ARCHIVE_FILE = 'figures.zip'
 IMAGES_PER_NUMBER_FOLDER = 'nims'
 PLATES_FOLDER = 'plates'
\ No newline at end of file
@@ -1,42 +1,102 @@
 import os
 import os.path as osp
+import argparse
+import hashlib
 import json
 import numpy as np
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 
 
-def process(img_dir='data/colours-img', json_file='rgb.json'):
+def plate_number(img):
+    img = osp.splitext(img)[0].strip()
+    assert img.startswith('10')
+    img = img[2:].replace('_pixelsquare', '')
+    assert img.isdigit()
+    return int(img)
+
+
+def file_hash(file):
+    with open(file, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def plate_colour(file):
+    '''
+    Extract the colour of the object of an image and its variance over the pixels of the object.
+    '''
+    I = plt.imread(file)
+    if np.size(I, axis=-1) > 3:
+        print(osp.basename(file))
+        I = (255*(I[:,:,:3]*I[:,:,3:] + 1 - I[:,:,3:])).astype(int)
+    LI = np.reshape(I, (-1, 3))
+    LI = I > np.mean(LI, axis=0)
+    LI = np.mean(LI, axis=-1) > 0.5
+    if LI[0,0]:
+        LI = np.logical_not(LI)
+    colour = (
+        np.mean(I[:,:,0][LI])/255,
+        np.mean(I[:,:,1][LI])/255,
+        np.mean(I[:,:,2][LI])/255,
+    )
+    variance = tuple(np.var(I[LI]/255, axis=0).tolist())
+    return colour, variance
+
+
+def process(img_dir='data/colours-img', json_file='rgb.json', binary_file='rgb.npz', manifest_file='data/manifest.json', workers=0):
     '''
     Extract from a set of images the corresponding colour of each image.
     This should be used on images of specifically colour objects.
+    The colours are kept in a manifest with the modification time and hash of each image,
+    so that only the new or changed images are processed, on a pool of processes (0 using all cores).
+    The colours are also saved as a binary palette, with their variance, to be loaded without parsing the json.
     '''
-    d = {}
+    manifest = {}
+    if osp.exists(manifest_file):
+        with open(manifest_file, 'r') as m:
+            manifest = json.load(m)
     imgs = sorted(os.listdir(img_dir))
-    for index, img in enumerate(imgs):
-        I = plt.imread(osp.join(img_dir, img))
-        if np.size(I, axis=-1) > 3:
-            print(img)
-            I = (255*(I[:,:,:3]*I[:,:,3:] + 1 - I[:,:,3:])).astype(int)
-        LI = np.reshape(I, (-1, 3))
-        LI = I > np.mean(LI, axis=0)
-        LI = np.mean(LI, axis=-1) > 0.5
-        if LI[0,0]:
-            LI = np.logical_not(LI)
-        colour = (
-            np.mean(I[:,:,0][LI])/255,
-            np.mean(I[:,:,1][LI])/255,
-            np.mean(I[:,:,2][LI])/255,
-        )
-        img = osp.splitext(img)[0].strip()
-        assert img.startswith('10')
-        img = img[2:].replace('_pixelsquare', '')
-        assert img.isdigit()
-        img = int(img)
-        d[img] = colour
-        print(f'{index} of {len(imgs)}')
-    with open(json_file, 'w') as j:
-        json.dump(d, j, indent=2)
+    entries = {}
+    todo = []
+    for img in imgs:
+        file = osp.join(img_dir, img)
+        entry = manifest.get(img, {})
+        mtime = osp.getmtime(file)
+        if entry.get('mtime') != mtime:
+            digest = file_hash(file)
+            if entry.get('hash') != digest:
+                todo.append(img)
+            entry = {**entry, 'mtime' : mtime, 'hash' : digest}
+        entries[img] = entry
+    print(f'{len(todo)} of {len(imgs)} images to process')
+    with ProcessPoolExecutor(max_workers=workers or None) as executor:
+        files = [osp.join(img_dir, img) for img in todo]
+        for index, (img, (colour, variance)) in enumerate(zip(todo, executor.map(plate_colour, files))):
+            entries[img]['colour'] = colour
+            entries[img]['variance'] = variance
+            print(f'{index} of {len(todo)}')
+    with open(manifest_file, 'w') as m:
+        json.dump(entries, m, indent=2)
+
+    d = {plate_number(img) : entry['colour'] for img, entry in entries.items()}
+    if osp.exists(json_file):
+        with open(json_file, 'r') as j:
+            changed = json.load(j) != json.loads(json.dumps(d))
+    else:
+        changed = True
+    if changed:
+        with open(json_file, 'w') as j:
+            json.dump(d, j, indent=2)
+    np.savez(
+        binary_file,
+        numbers=np.array(list(d), dtype=np.uint16),
+        colours=np.array(list(d.values()), dtype=float),
+        variances=np.array([entry['variance'] for entry in entries.values()], dtype=float),
+    )
 
 
 if __name__ == '__main__':
-    process()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=0,
+        help='The number of processes extracting the colours of the new images, 0 using all cores.')
+    process(**vars(parser.parse_args()))
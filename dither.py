@@ -0,0 +1,54 @@
+import numpy as np
+
+from config import *
+
+
+def bayer_matrix(size=BAYER_SIZE):
+    '''
+    Ordered dithering thresholds of a size by size Bayer matrix, centred around 0 in (-0.5, 0.5).
+    '''
+    M = np.zeros((1, 1))
+    while len(M) < size:
+        M = np.block([[4*M, 4*M + 2], [4*M + 3, 4*M + 1]])
+    return (M + 0.5)/M.size - 0.5
+
+
+def bayer_dither(rim, index, size=BAYER_SIZE, spread=DITHER_SPREAD):
+    '''
+    Match every pixel to a colour of the palette after adding a tiled Bayer threshold to the image.
+    The threshold amplitude is spread times the mean spacing of the palette in the RGB cube.
+    '''
+    nx, ny = rim.shape[:2]
+    M = bayer_matrix(size)
+    M = np.tile(M, (int(np.ceil(nx/size)), int(np.ceil(ny/size))))[:nx,:ny]
+    amplitude = spread/np.cbrt(len(index.colours))
+    return index.query(rim + amplitude*M[...,None])
+
+
+def floyd_steinberg(rim, index):
+    '''
+    Match every pixel to a colour of the palette, diffusing the error to the next pixels with Floyd-Steinberg weights.
+    Pixel (i, j) only receives errors from pixels with a smaller 2i + j, so each anti-diagonal 2i + j = t
+    is matched at once, giving the same result as the pixel by pixel scan in 2nx + ny - 2 steps.
+    '''
+    im = np.array(rim, dtype=float)
+    nx, ny = im.shape[:2]
+    iim = np.zeros((nx, ny), dtype=int)
+    for t in range(2*(nx - 1) + ny):
+        i = np.arange(max(0, (t - ny + 2)//2), min(nx - 1, t//2) + 1)
+        j = t - 2*i
+        iim[i,j] = index.query(im[i,j])
+        error = im[i,j] - index.colours[iim[i,j]]
+        for di, dj, weight in FLOYD_STEINBERG:
+            inside = (i + di < nx) & (j + dj >= 0) & (j + dj < ny)
+            im[i[inside] + di,j[inside] + dj] += weight*error[inside]
+    return iim
+
+
+def dither(rim, index, method):
+    if method == 'bayer':
+        return bayer_dither(rim, index)
+    elif method == 'floyd':
+        return floyd_steinberg(rim, index)
+    else:
+        raise ValueError(f'unknown dither method {method!r}, expected one of bayer, floyd')
@@ -0,0 +1,40 @@
+import numpy as np
+from PIL import Image
+
+from config import *
+
+
+class ImageSource(object):
+    '''
+    Read an image by strips of rows, as floats between 0 and 1.
+    Numpy .npy files are memory-mapped so that only the rows read are loaded.
+    Other images are decoded once by Pillow with 8-bit channels, each strip being converted to floats on its own.
+    '''
+
+    def __init__(self, image):
+        self.image = image
+        if self.image.endswith('.npy'):
+            self.pixels = np.load(self.image, mmap_mode='r')
+            self.imx, self.imy = self.pixels.shape[:2]
+        else:
+            self.pixels = None
+            with Image.open(self.image) as im:
+                self.imy, self.imx = im.size
+
+    def decode(self):
+        with Image.open(self.image) as im:
+            if im.mode not in ['RGB', 'RGBA']:
+                im = im.convert('RGBA' if 'A' in im.getbands() else 'RGB')
+            self.pixels = np.asarray(im)
+
+    def read(self, start, end):
+        if self.pixels is None:
+            self.decode()
+        strip = np.asarray(self.pixels[start:end], dtype=float)
+        if strip.ndim == 2:
+            strip = np.stack([strip]*RGB_DIM, axis=-1)
+        if np.issubdtype(self.pixels.dtype, np.integer):
+            strip = strip/RGB_MAX_INT
+        if np.size(strip, axis=-1) > RGB_DIM:
+            strip = strip[:,:,:RGB_DIM]*strip[:,:,RGB_DIM:]
+        return strip
@@ -0,0 +1,205 @@
+import os
+import os.path as osp
+import io
+import argparse
+import glob
+import json
+import numpy as np
+from contextlib import redirect_stdout
+
+from config import *
+
+
+def read_pixels(file=None):
+    '''
+    Read a file of available pixels, with a colour and its number of pixels on each line.
+    '''
+    pixels = {}
+    if file is not None:
+        with open(file, 'r') as p:
+            for line in p:
+                line = line.strip()
+                if line:
+                    col, num = line.split('\t')
+                    pixels[int(col)] = int(num)
+    return pixels
+
+
+def read_results(results):
+    '''
+    List the jobs whose plates are pooled, from the summary of a batch, or from the output folders
+    (or their plates.json files) matching a pattern, a folder standing for all the output folders it contains.
+    The jobs of a batch summary keep their parameters and palette, so that their colours can be matched again.
+    '''
+    if results.endswith('.json') and osp.basename(results) != PLATES_INFO:
+        with open(results, 'r') as s:
+            jobs = [job for job in json.load(s)['images'] if 'output' in job]
+    else:
+        if osp.isdir(results):
+            results = osp.join(results, f'{OUTPUT_FOLDER}*')
+        jobs = [
+            {'output' : match if osp.isdir(match) else osp.dirname(match)}
+            for match in sorted(glob.glob(results))
+        ]
+    return [job for job in jobs if osp.exists(osp.join(job['output'], PLATES_INFO))]
+
+
+def job_pixels(job):
+    with open(osp.join(job['output'], PLATES_INFO), 'r') as p:
+        return {int(col) : infos['pixels'] for col, infos in json.load(p).items()}
+
+
+def count_matrix(pixels, numbers):
+    '''
+    Count the pixels of each colour (columns, in the order of numbers) of each job (rows),
+    from the number of pixels of each colour of the jobs.
+    '''
+    column = {number : index for index, number in enumerate(numbers)}
+    counts = np.zeros((len(pixels), len(numbers)), dtype=int)
+    for row, pixel_counts in enumerate(pixels):
+        counts[row,[column[col] for col in pixel_counts]] = list(pixel_counts.values())
+    return counts
+
+
+def purchase(totals, stock):
+    '''
+    Number of squares to buy for the pooled pixels of each colour once the stock is used,
+    and the number of pixels left over after the purchase.
+    '''
+    squares = np.ceil(np.maximum(totals - stock, 0)/PIXELS_PER_SQUARE).astype(int)
+    return squares, stock + PIXELS_PER_SQUARE*squares - totals
+
+
+def plan_substitutions(colours, totals, stock, threshold):
+    '''
+    Replace the colours low in stock by colours closer than threshold in RGB with enough pixels left over.
+    The colours needing the fewest pixels are replaced first, each by its closest candidate,
+    and a colour replacing another one is not replaced itself.
+    Returns the index of the substitute of each replaced colour.
+    '''
+    D = np.sqrt(np.sum((colours[:,None,:] - colours[None,:,:])**2, axis=-1))
+    np.fill_diagonal(D, np.inf)
+    squares, leftovers = purchase(totals, stock)
+    replaced = np.zeros(len(totals), dtype=bool)
+    substitute = np.zeros(len(totals), dtype=bool)
+    substitutes = {}
+    for c in np.argsort(totals, kind='stable'):
+        if not squares[c] or substitute[c]:
+            continue
+        candidates = (D[c] <= threshold) & (leftovers >= totals[c]) & ~replaced
+        if not np.any(candidates):
+            continue
+        d = np.argmin(np.where(candidates, D[c], np.inf))
+        leftovers[d] -= totals[c]
+        replaced[c] = True
+        substitute[d] = True
+        substitutes[c] = d
+    return substitutes
+
+
+def count_job(job):
+    '''
+    Match the colours of an image and count the pixels of each colour, without writing any output.
+    '''
+    from pixel import Pixel
+    image, kwargs = job
+    with redirect_stdout(io.StringIO()):
+        pixel = Pixel(image=image, no_output=1, **kwargs)
+    return {int(number) : int(count) for number, count in zip(pixel.numbers, pixel.counts) if count}
+
+
+def substitute_jobs(jobs, substitutes):
+    '''
+    List the jobs of a batch using a replaced colour, with the substitutes in their palette.
+    Returns the indices of these jobs and their new image and parameters.
+    '''
+    indices = []
+    job_list = []
+    for index, job in enumerate(jobs):
+        if 'parameters' not in job or not set(map(int, job['palette'])) & set(substitutes):
+            continue
+        palette = sorted(set(substitutes.get(int(col), int(col)) for col in job['palette']))
+        indices.append(index)
+        job_list.append((job['image'], {**job['parameters'], 'colours' : '-'.join(map(str, palette))}))
+    return indices, job_list
+
+
+def inventory(results, pixel_file=None, threshold=0., apply=0, jobs=1, output=INVENTORY_FOLDER):
+    '''
+    Compute the squares to buy for all the jobs at once, pooling their pixels and the available pixels.
+    If threshold is positive, the colours low in stock are replaced by near-equivalent colours:
+    the colours of the jobs of a batch summary are matched again with their new palette,
+    only counting their pixels on a pool of jobs processes, while the pixels of the other jobs are moved to the substitute.
+    If apply is set, the jobs matched again are then rendered to their output folder,
+    and their new summary is saved with the others.
+    '''
+    from palette import load_rgb
+    from batch import map_jobs, run_job
+    rgb = load_rgb()
+    jobs_info = read_results(results)
+    pixels = read_pixels(pixel_file)
+    plates = [job_pixels(job) for job in jobs_info]
+    palettes = [set(map(int, job.get('palette', []))) for job in jobs_info]
+    numbers = sorted(set(pixels).union(*plates, *palettes))
+    counts = count_matrix(plates, numbers)
+    stock = np.array([pixels.get(number, 0) for number in numbers])
+    separate = int(np.sum(np.ceil(counts/PIXELS_PER_SQUARE)))
+    substitutions = {}
+    if threshold > 0:
+        colours = np.reshape([rgb[str(number)] for number in numbers], (-1, RGB_DIM))
+        substitutes = plan_substitutions(colours, np.sum(counts, axis=0), stock, threshold)
+        substitutions = {int(numbers[c]) : int(numbers[d]) for c, d in substitutes.items()}
+        indices, job_list = substitute_jobs(jobs_info, substitutions)
+        counts[indices] = count_matrix(list(map_jobs(count_job, job_list, jobs)), numbers)
+        moved = np.setdiff1d(np.arange(len(jobs_info)), indices)
+        for c, d in substitutes.items():
+            counts[moved,d] += counts[moved,c]
+            counts[moved,c] = 0
+        print(f'{len(substitutions)} colours replaced, {len(indices)} jobs matched again')
+    squares, leftovers = purchase(np.sum(counts, axis=0), stock)
+    print(f'{len(jobs_info)} jobs: {np.sum(squares)} squares to buy ({separate} for the images separately without stock)')
+
+    os.makedirs(output, exist_ok=True)
+    with open(osp.join(output, PURCHASE_FILE), 'w') as p:
+        for number, num, extra in zip(numbers, squares, leftovers):
+            if num:
+                p.write(f'{number}\t{num}\t({extra})\n')
+        p.write(f'Total: {np.sum(squares)}')
+    with open(osp.join(output, LEFTOVERS_FILE), 'w') as p:
+        for number, extra in zip(numbers, leftovers):
+            if extra:
+                p.write(f'{number}\t{extra}\n')
+    with open(osp.join(output, SUBSTITUTIONS_FILE), 'w') as s:
+        json.dump(substitutions, s, indent=2)
+
+    if apply and substitutions:
+        for index, result in zip(indices, map_jobs(run_job, job_list, jobs)):
+            jobs_info[index] = result
+            status = result.get('error', f'{result["time"]:.1f}s')
+            print(f'Rendered {result["image"]} ({status})')
+        with open(osp.join(output, BATCH_SUMMARY), 'w') as s:
+            json.dump({'images' : jobs_info}, s, indent=2)
+    return squares, leftovers, substitutions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--results', type=str, required=True,
+        help='''
+        The jobs to pool, either the json summary of a batch, a folder of outputs,
+        or a glob pattern of output folders or of their plates.json files.
+        ''')
+    parser.add_argument('--pixel_file', type=str, default=None,
+        help='The file of number of already available pixels.')
+    parser.add_argument('--threshold', type=float, default=0.,
+        help='''
+        The RGB distance under which a colour low in stock can be replaced by another one with pixels left over,
+        0 not replacing any colour.
+        ''')
+    parser.add_argument('--apply', type=int, default=0,
+        help='Whether to render the jobs matched again with their substitutes, replacing their output.')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='The number of processes matching and rendering the jobs again, 0 using all cores.')
+    parser.add_argument('--output', type=str, default=INVENTORY_FOLDER,
+        help='The folder of the squares to buy, the pixels left over, and the replaced colours.')
+    inventory(**vars(parser.parse_args()))
@@ -1,12 +1,23 @@
 import argparse
-from pixel import Pixel
 
+from config import *
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
+
+class ParameterParser(argparse.ArgumentParser):
+    '''
+    Parser of parameters given outside of the command line, raising a ValueError instead of printing the error and exiting.
+    '''
+
+    def error(self, message):
+        raise ValueError(message)
+
+
+def get_parser(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser()
     parser.add_argument('--image', type=str, default='image.jpg',
-        help='The image to be pixelized.')
-    parser.add_argument('--orientation', type=str, default='default',
+        help='The image to be pixelized, either an image file or a numpy .npy array of pixels.')
+    parser.add_argument('--orientation', type=str, default='default', choices=['default', 'v', 'vertical', 'h', 'horizontal'],
         help='If the pixel plates should be placed by default, vertically, or horizontally.')
     parser.add_argument('--halign', type=str, default='center',
         help='''
@@ -23,6 +34,17 @@ if __name__ == '__main__':
         The number of horizontal and vertical plates.
         Either a single number or two numbers with an 'x' in-between.
         ''')
+    parser.add_argument('--resample', type=str, default='crop', choices=['crop', 'area'],
+        help='''
+        How the image is reduced to the pixel grid.
+        Can be either 'crop', averaging square blocks of an integer size and cropping the remainder,
+        or 'area', averaging cells of any size with area-weighted resampling of the whole image.
+        ''')
+    parser.add_argument('--strip_rows', type=int, default=0,
+        help='''
+        If positive, the image is read and reduced by strips of about this many rows,
+        bounding the memory used by the floating point pixels. Numpy .npy images are memory-mapped.
+        ''')
     parser.add_argument('--colours', type=str, default='basic',
         help='''
             the colours to be used for the pixelized image.
@@ -33,17 +55,73 @@ if __name__ == '__main__':
             - of the form 'topXimage' to pick the top X colours of the image; or
             - one of the pre-implemented options ('primary' 'basic', 'classic', or 'all').
         ''')
+    parser.add_argument('--palette_method', type=str, default='kmeans', choices=['kmeans', 'minibatch', 'histogram', 'mediancut'],
+        help='''
+        How the top colours are extracted for the 'topX' and 'topXimage' colours.
+        Can be either 'kmeans' (slow), 'minibatch', 'histogram' (k-means on a colour histogram), or 'mediancut'.
+        ''')
     parser.add_argument('--pixelsize', type=str, default='1',
         help='''
         The number of squares of the pixel plate used to represent a single pixel.
         This parameter can be used to mix simple colours to create more complec ones.
         Either a single or two numbers with an 'x' in-between.
         ''')
+    parser.add_argument('--metric', type=str, default='rgb', choices=['rgb', 'lab', 'oklab'],
+        help='''
+        The colour space in which the pixels are compared to the plate colours.
+        Can be either 'rgb', 'lab' (CIELAB), or 'oklab', the last two being closer to the perceived differences.
+        ''')
+    parser.add_argument('--search', type=str, default='brute', choices=['brute', 'multiset'],
+        help='''
+        How the colour pattern of each pixel is found.
+        Can be either 'brute', comparing each pixel to every pattern of colours,
+        or 'multiset', searching the multisets of colours without listing all the patterns.
+        ''')
+    parser.add_argument('--exact', type=int, default=1,
+        help='''
+        Whether the 'multiset' search is exact.
+        If not, a faster greedy search refines the colours one square at a time.
+        ''')
+    parser.add_argument('--lut', type=int, default=0,
+        help='''
+        The number of bits per channel of the colour lookup table used for single-square pixels.
+        A lookup table of 6 bits (64x64x64) or 8 bits (256x256x256) is faster but approximate,
+        while 0 uses an exact KD-tree.
+        ''')
+    parser.add_argument('--dither', type=str, default='none', choices=['none', 'bayer', 'floyd'],
+        help='''
+        How the colours are mixed without a larger pixel size, only for single-square pixels.
+        Can be either 'none', 'bayer' for ordered dithering, or 'floyd' for Floyd-Steinberg error diffusion.
+        ''')
+    parser.add_argument('--max_memory', type=float, default=MATCH_MEMORY,
+        help='The memory budget in megabytes for matching the pixels to the colour options.')
     parser.add_argument('--draft', type=int, default=1,
         help='Whether using the draft mode, only testing the image output.')
     parser.add_argument('--dpi', type=int, default=20,
         help='The dpi for all images.')
+    parser.add_argument('--backend', type=str, default='matplotlib', choices=['matplotlib', 'raster'],
+        help='''
+        How the images are drawn.
+        Can be either 'matplotlib', or 'raster' to write the pixels directly with Pillow (faster).
+        ''')
+    parser.add_argument('--compression', type=int, default=PNG_COMPRESSION, choices=range(10),
+        help='The zlib compression level of the png images, from 0 (fastest) to 9 (smallest).')
+    parser.add_argument('--archive', type=int, default=0,
+        help='Whether to write the images of each colour and plate to a single zip file instead of the nims and plates folders.')
+    parser.add_argument('--workers', type=int, default=1,
+        help='The number of processes rendering the images of each colour and plate, 0 using all cores.')
+    parser.add_argument('--incremental', type=int, default=0,
+        help='Whether to keep the previous output and only render again the images whose content changed.')
+    parser.add_argument('--no_cache', type=int, default=0,
+        help='Whether to recompute every stage instead of reusing the cached results of previous runs.')
+    parser.add_argument('--profile', type=int, default=0,
+        help='Whether to also save a cProfile of the run next to the profile of each stage.')
     parser.add_argument('--pixel_file', type=str, default=None,
         help='The file of number of already available pixels.')
-    kwargs = vars(parser.parse_args())
+    return parser
+
+
+if __name__ == '__main__':
+    kwargs = vars(get_parser().parse_args())
+    from pixel import Pixel
     Pixel(**kwargs)
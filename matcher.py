@@ -0,0 +1,73 @@
+import numpy as np
+
+from config import *
+from palette import index_dtype
+from cache import MemoryCache
+
+
+def to_blocks(im, xps, yps):
+    xsteps = int(np.size(im, axis=0)/xps)
+    ysteps = int(np.size(im, axis=1)/yps)
+    blocks = np.reshape(im, (xsteps, xps, ysteps, yps) + im.shape[2:])
+    blocks = np.swapaxes(blocks, 1, 2)
+    return np.reshape(blocks, (xsteps*ysteps, xps, yps) + im.shape[2:])
+
+
+def from_blocks(blocks, xsteps, ysteps):
+    xps = np.size(blocks, axis=1)
+    yps = np.size(blocks, axis=2)
+    im = np.reshape(blocks, (xsteps, ysteps, xps, yps) + blocks.shape[3:])
+    im = np.swapaxes(im, 1, 2)
+    return np.reshape(im, (xsteps*xps, ysteps*yps) + blocks.shape[3:])
+
+
+COLOUR_OPTIONS = MemoryCache()
+
+def colour_options(rgb, xps, yps):
+    '''
+    List all the patterns of xps by yps colours of the palette.
+    Returns the palette indices of the patterns of shape (xps, yps, options), in the smallest unsigned type.
+    The last patterns are kept in memory to be reused by the next images with the same palette.
+    '''
+    key = (tuple((number, tuple(colour)) for number, colour in rgb.items()), xps, yps)
+    return COLOUR_OPTIONS.get(key, lambda: list_colour_options(len(rgb), xps, yps))
+
+
+def list_colour_options(n_colours, xps, yps):
+    option = np.indices((n_colours,)*(xps*yps), dtype=index_dtype(n_colours))
+    return np.reshape(option, (xps, yps, -1))
+
+
+def block_distances(D):
+    '''
+    Compute the distance between a batch of blocks and all colour options.
+    D is the difference of shape (blocks, xps, yps, RGB_DIM, options).
+    The options whose mean colour is not the closest to the mean of the block are penalized.
+    '''
+    mean = np.mean(np.abs(np.mean(np.mean(D, axis=1), axis=1))**DIST_POWER, axis=1)**(1/DIST_POWER)
+    dist = np.mean(np.mean(np.mean(np.abs(D)**DIST_POWER, axis=3)**(1/DIST_POWER), axis=1), axis=1)
+    dist += mean > np.min(mean, axis=1, keepdims=True)
+    return dist
+
+
+def match_blocks(rim, palette, option, max_memory=MATCH_MEMORY, progress=None):
+    '''
+    Match every block of the reduced image to its closest colour option.
+    The blocks are processed in chunks so that the difference tensors stay within max_memory megabytes.
+    Returns the image of palette indices.
+    '''
+    xps, yps = option.shape[:2]
+    xsteps = int(np.size(rim, axis=0)/xps)
+    ysteps = int(np.size(rim, axis=1)/yps)
+    colour = np.moveaxis(np.asarray(palette, dtype=float)[option], -1, 2)
+    blocks = to_blocks(rim, xps, yps)[...,None]
+    nblocks = len(blocks)
+    chunk = max(1, int(max_memory*2**20/(MATCH_MEMORY_FACTOR*colour.nbytes)))
+    index = np.zeros(nblocks, dtype=int)
+    for start in range(0, nblocks, chunk):
+        end = min(start + chunk, nblocks)
+        dist = block_distances(blocks[start:end] - colour)
+        index[start:end] = np.argmin(dist, axis=1)
+        if progress is not None:
+            progress(end, nblocks)
+    return from_blocks(np.moveaxis(option, -1, 0)[index], xsteps, ysteps)
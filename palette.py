@@ -0,0 +1,196 @@
+import os.path as osp
+import json
+import numpy as np
+
+from config import *
+from colourspace import convert, convert_palette
+from cache import MemoryCache
+
+
+RGB_DICTS = {}
+
+def load_rgb(file=RGB_DICT, binary=RGB_BINARY):
+    '''
+    Load the colours of the plates, reusing the ones already loaded if the file did not change.
+    The binary palette is read instead of the json file when it is at least as recent.
+    '''
+    if osp.exists(binary) and osp.getmtime(binary) >= osp.getmtime(file):
+        file = binary
+    key = (osp.abspath(file), osp.getmtime(file))
+    if key not in RGB_DICTS:
+        if file == binary:
+            with np.load(file) as b:
+                RGB_DICTS[key] = {str(number) : colour.tolist() for number, colour in zip(b['numbers'], b['colours'])}
+        else:
+            with open(file, 'r') as d:
+                RGB_DICTS[key] = json.load(d)
+    return RGB_DICTS[key].copy()
+
+
+def index_dtype(n_colours):
+    '''
+    Smallest unsigned integer type indexing a palette of n_colours.
+    '''
+    return np.uint8 if n_colours <= 2**8 else np.uint16
+
+
+def palette_table(rgb):
+    '''
+    Table of a palette: the colours and the uint16 plate numbers, in the order of rgb.
+    The colours are kept in double precision so that the images render exactly as the rgb colours.
+    '''
+    colours = np.array(list(rgb.values()), dtype=float)
+    numbers = np.array([int(number) for number in rgb], dtype=np.uint16)
+    return colours, numbers
+
+
+class PaletteIndex(object):
+    '''
+    Nearest-colour index over a palette of plate colours, built once per palette, distance and colour space.
+    Queries compare to every colour of the palette, go through a KD-tree built on the first query
+    of many colours to a large palette, or through a lookup table of the quantized RGB cube if lut_bits is set.
+    The lookup table is kept in the on-disk cache if one is given, to be reused by the next runs.
+    '''
+
+    def __init__(self, rgb, power=DIST_POWER, lut_bits=0, metric='rgb', cache=None):
+        self.keys = np.array(list(rgb))
+        self.colours = np.array(list(rgb.values()), dtype=float)
+        self.power = power
+        self.metric = metric
+        self.converted = convert_palette(rgb, self.metric)
+        self.tree = None
+        self.lut_bits = lut_bits
+        if self.lut_bits:
+            self.__lut__(cache)
+
+    def __lut__(self, cache):
+        if cache is None:
+            self.lut = self.build_lut()
+        else:
+            params = [self.keys.tolist(), self.colours.tolist(), self.power, self.lut_bits, self.metric]
+            self.lut = cache.cached('lut', params, lambda: {'lut' : self.build_lut()})[0]['lut']
+
+    def build_lut(self):
+        size = 2**self.lut_bits
+        centres = (np.arange(size) + 0.5)/size
+        lut = np.zeros((size, size, size), dtype=np.uint16)
+        for r in range(size):
+            grid = np.stack(np.meshgrid([centres[r]], centres, centres, indexing='ij'), axis=-1)
+            lut[r] = self.exact_query(grid)[0]
+        return lut
+
+    def exact_query(self, X):
+        X = convert(X, self.metric)
+        flat = np.reshape(X, (-1, RGB_DIM))
+        if len(self.colours) > NEAREST_BRUTE_COLOURS and len(flat) > NEAREST_BRUTE_POINTS:
+            if self.tree is None:
+                from sklearn.neighbors import KDTree
+                self.tree = KDTree(self.converted, metric='minkowski', p=self.power)
+            index = self.tree.query(flat, k=1, return_distance=False)
+        else:
+            index = np.zeros(len(flat), dtype=int)
+            chunk = max(1, int(NEAREST_CHUNK/len(self.colours)))
+            for start in range(0, len(flat), chunk):
+                D = np.abs(flat[start:start + chunk,None,:] - self.converted)**self.power
+                index[start:start + chunk] = np.argmin(np.sum(D, axis=-1), axis=1)
+        return np.reshape(index, X.shape[:-1])
+
+    def query(self, X):
+        if self.lut_bits:
+            size = 2**self.lut_bits
+            Q = np.clip((np.asarray(X)*size).astype(int), 0, size - 1)
+            return self.lut[Q[...,0],Q[...,1],Q[...,2]]
+        return self.exact_query(X)
+
+    def nearest_keys(self, X):
+        return self.keys[self.query(X)]
+
+    def nearest_colours(self, X):
+        return self.colours[self.query(X)]
+
+
+PALETTE_INDICES = MemoryCache()
+
+def palette_index(rgb, power=DIST_POWER, lut_bits=0, metric='rgb', cache=None):
+    '''
+    Get the index of a palette, reusing the one recently built for the same palette and parameters.
+    The lookup table of a new index is loaded from or saved to the on-disk cache if one is given.
+    '''
+    colours = np.array(list(rgb.values()), dtype=float)
+    key = (tuple(rgb), colours.tobytes(), power, lut_bits, metric)
+    return PALETTE_INDICES.get(key, lambda: PaletteIndex(rgb, power, lut_bits, metric, cache))
+
+
+def cluster_means(X, clusters, n_clusters):
+    return np.stack([np.mean(X[clusters==v,:], axis=0) for v in range(n_clusters)])
+
+
+def histogram(X, bits=HISTOGRAM_BITS):
+    '''
+    Reduce a set of colours to the mean colour and count of each non-empty bin of the quantized RGB cube.
+    '''
+    size = 2**bits
+    Q = np.clip((X*size).astype(int), 0, size - 1)
+    bins = (Q[:,0]*size + Q[:,1])*size + Q[:,2]
+    bins, inverse, counts = np.unique(bins, return_inverse=True, return_counts=True)
+    means = np.stack([
+        np.bincount(inverse, weights=X[:,c], minlength=len(bins))
+        for c in range(RGB_DIM)
+    ], axis=-1)/counts[:,None]
+    return means, counts
+
+
+def median_cut(X, n_colours, weights=None):
+    '''
+    Split the colours into boxes, always cutting the box with the widest channel at its weighted median.
+    '''
+    if weights is None:
+        weights = np.ones(len(X))
+    boxes = [np.arange(len(X))]
+    while len(boxes) < n_colours:
+        ranges = [np.ptp(X[box], axis=0) if len(box) > 1 else np.zeros(RGB_DIM) for box in boxes]
+        widest = int(np.argmax([np.max(r) for r in ranges]))
+        if np.max(ranges[widest]) == 0:
+            break
+        box = boxes.pop(widest)
+        channel = np.argmax(ranges[widest])
+        box = box[np.argsort(X[box,channel], kind='stable')]
+        cumulative = np.cumsum(weights[box])
+        cut = int(np.searchsorted(cumulative, cumulative[-1]/2))
+        cut = min(max(cut, 1), len(box) - 1)
+        boxes += [box[:cut], box[cut:]]
+    return np.stack([np.average(X[box], axis=0, weights=weights[box]) for box in boxes])
+
+
+def extract_palette(X, n_colours, method='kmeans'):
+    '''
+    Extract the n_colours main colours of a set of colours.
+    The method can be the full 'kmeans', a faster 'minibatch' k-means,
+    a k-means over the colour 'histogram' weighted by the bin counts, or 'mediancut'.
+    '''
+    if method == 'kmeans':
+        from sklearn.cluster import KMeans
+        clusters = KMeans(n_clusters=n_colours, **KMEANS_PARAMS).fit_predict(X)
+        return cluster_means(X, clusters, n_colours)
+    elif method == 'minibatch':
+        from sklearn.cluster import MiniBatchKMeans
+        clusters = MiniBatchKMeans(n_clusters=n_colours, **MINIBATCH_KMEANS_PARAMS).fit_predict(X)
+        return cluster_means(X, clusters, n_colours)
+    elif method == 'histogram':
+        from sklearn.cluster import KMeans
+        means, counts = histogram(X)
+        kmeans = KMeans(n_clusters=min(n_colours, len(means)), **HISTOGRAM_KMEANS_PARAMS)
+        return kmeans.fit(means, sample_weight=counts).cluster_centers_
+    elif method == 'mediancut':
+        means, counts = histogram(X)
+        return median_cut(means, n_colours, weights=counts)
+    else:
+        raise ValueError(f'unknown palette method {method!r}, expected one of kmeans, minibatch, histogram, mediancut')
+
+
+def palette_error(X, colours):
+    '''
+    Mean distance between each colour and its closest colour of the palette.
+    '''
+    D = np.mean(np.abs(X[:,None,:] - colours)**DIST_POWER, axis=-1)**(1/DIST_POWER)
+    return np.mean(np.min(D, axis=-1))
@@ -2,198 +2,266 @@ import os
 import os.path as osp
 import json
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
 import sys
 import shutil
 
 from __init__ import PixelInit
 from config import *
+from matcher import colour_options, match_blocks
+from search import search_blocks
+from palette import palette_index, index_dtype
+from colourspace import convert, convert_palette
+from dither import dither
+from cache import fingerprint
+from writer import Writer
+import render
 
 
 class Pixel(PixelInit):
 
-    def __init__(self, draft, dpi, pixel_file=None, **kwargs):
+    def __init__(self, draft, dpi, pixel_file=None, max_memory=MATCH_MEMORY, search='brute', exact=1, lut=0, dither='none', workers=1, backend='matplotlib', compression=PNG_COMPRESSION, archive=0, incremental=0, no_output=0, **kwargs):
         super().__init__(**kwargs)
         self.draft = draft
         self.dpi = dpi
         self.pixel_file = pixel_file
+        self.max_memory = max_memory
+        assert search in ['brute', 'multiset']
+        self.search = search
+        self.exact = exact
+        self.lut = lut
+        assert dither in ['none', 'bayer', 'floyd']
+        assert dither == 'none' or self.xps*self.yps == 1, 'dithering only applies to single-square pixels'
+        self.dither = dither
+        self.workers = workers
+        assert backend in ['matplotlib', 'raster']
+        self.backend = backend
+        assert 0 <= compression <= 9
+        self.compression = compression
+        self.archive = archive
         folder, file = osp.split(self.image)
         file = osp.splitext(file)[0]
         self.im_name = file
         self.save_dir = osp.join(folder, f'{OUTPUT_FOLDER}{file}')
-        if osp.exists(self.save_dir):
-            shutil.rmtree(self.save_dir)
-        os.makedirs(self.save_dir)
+        self.__output__(incremental, no_output)
         self.run()
 
-    def set_image(self, im, figsize=None, extent=None, cmap=None):
-        if figsize is None:
-            figsize = (self.ny, self.nx)
-        if extent is None:
-            extent = (0, figsize[0], 0, figsize[1])
-        fig = plt.figure(figsize=figsize, dpi=self.dpi)
-        fig.subplots_adjust(left=0, right=1, bottom=0, top=1)
-        ax = fig.add_subplot()
-        ax.axis('off')
-        ax.set_xlim(xmin=0, xmax=figsize[0])
-        ax.set_ylim(ymin=0, ymax=figsize[1])
-        ax.imshow(im, extent=extent, cmap=cmap)
-        return fig, ax
+    def __output__(self, incremental, no_output):
+        self.incremental = incremental
+        self.no_output = no_output
+        self.manifest = {}
+        self.rendered = {}
+        if self.no_output:
+            return
+        if osp.exists(self.save_dir) and not self.incremental:
+            shutil.rmtree(self.save_dir)
+        os.makedirs(self.save_dir, exist_ok=True)
+        if osp.exists(osp.join(self.save_dir, MANIFEST_FILE)):
+            with open(osp.join(self.save_dir, MANIFEST_FILE), 'r') as m:
+                self.manifest = json.load(m)
+
+    def is_rendered(self, files, fingerprint, exists=osp.exists):
+        '''
+        Record the fingerprint of the content of some files and check if they are already up to date,
+        exists checking whether a file was kept from the previous run.
+        '''
+        is_rendered = True
+        for file in files:
+            name = osp.relpath(file, self.save_dir)
+            is_rendered = is_rendered and self.manifest.get(name) == fingerprint and exists(file)
+            self.rendered[name] = fingerprint
+        return is_rendered
+
+    def clean_figures(self):
+        '''
+        Remove the figures of the other output mode, the folders when archiving and the archive otherwise.
+        '''
+        if self.archive:
+            for folder in [IMAGES_PER_NUMBER_FOLDER, PLATES_FOLDER]:
+                shutil.rmtree(osp.join(self.save_dir, folder), ignore_errors=True)
+        else:
+            for file in [ARCHIVE_FILE, f'{ARCHIVE_FILE}.tmp']:
+                if osp.exists(osp.join(self.save_dir, file)):
+                    os.remove(osp.join(self.save_dir, file))
+
+    def clean_output(self, folders):
+        '''
+        Remove the files of the given folders that were not rendered in this run and save the manifest.
+        The files of the other folders are kept with their previous fingerprints.
+        '''
+        for name, fingerprint in self.manifest.items():
+            if osp.dirname(name) not in folders:
+                self.rendered.setdefault(name, fingerprint)
+        for folder in folders:
+            if osp.isdir(osp.join(self.save_dir, folder)):
+                for file in os.listdir(osp.join(self.save_dir, folder)):
+                    if osp.join(folder, file) not in self.rendered:
+                        os.remove(osp.join(self.save_dir, folder, file))
+        with open(osp.join(self.save_dir, MANIFEST_FILE), 'w') as m:
+            json.dump(self.rendered, m, indent=2, sort_keys=True)
+
+    @property
+    def pim(self):
+        return self.colour_table[self.iim]
+
+    @property
+    def nim(self):
+        return self.numbers[self.iim]
+
+    def colour_indices(self, counts):
+        '''
+        List the palette indices with a positive count, sorted by plate number.
+        '''
+        indices = np.argsort(self.numbers, kind='stable')
+        return indices[counts[indices] > 0]
+
+    def statistics(self):
+        '''
+        Count the pixels of each colour on each plate in a single pass over the image of palette indices.
+        '''
+        ncolours = len(self.numbers)
+        plates = np.reshape(self.iim, (self.xdim, self.pixelplate[0], self.ydim, self.pixelplate[1]))
+        plates = np.reshape(np.swapaxes(plates, 1, 2), (self.xdim*self.ydim, -1))
+        offsets = ncolours*np.arange(self.xdim*self.ydim)[:,None]
+        counts = np.bincount(np.ravel(plates + offsets), minlength=self.xdim*self.ydim*ncolours)
+        self.plate_counts = np.reshape(counts, (self.xdim, self.ydim, ncolours))
+        self.counts = np.sum(self.plate_counts, axis=(0, 1))
+        self.brightness = np.mean(self.colour_table, axis=1)
 
     def get_colour_options(self):
-        colour_options = [(
-            np.zeros((self.xps, self.yps, RGB_DIM), dtype=float),
-            np.zeros((self.xps, self.yps), dtype=int),
-        )]
-        for i in range(self.xps):
-            for j in range(self.yps):
-                pre_options = colour_options.copy()
-                colour_options = []
-                for colour, option in pre_options:
-                    for number, rgb in self.rgb.items():
-                        colour[i,j,:] = rgb
-                        option[i,j] = number
-                        colour_options.append((
-                            colour.copy(),
-                            option.copy(),
-                        ))
-        colour, option = zip(*colour_options)
-        colour = np.stack(colour, axis=-1)
-        option = np.stack(option, axis=-1)
+        with self.profiler.stage('options'):
+            option = colour_options(self.rgb, self.xps, self.yps)
+        self.profiler.count('colour_options', np.size(option, axis=-1))
         print(f'Time to get colour options: {self.timer()}')
-        return colour, option
+        return option
 
-    def pixel_im(self):
-        colour, option = self.get_colour_options()
+    def match(self):
+        option = None
+        if self.search == 'brute' and self.xps*self.yps > 1:
+            option = self.get_colour_options()
         print(f'0% of pixel image: {self.timer()}')
-        self.pim = np.zeros((self.nx, self.ny, RGB_DIM), dtype=float)
-        self.nim = np.zeros((self.nx, self.ny), dtype=int)
-        xsteps = int(self.nx/self.xps)
-        ysteps = int(self.ny/self.yps)
-        for i in range(xsteps):
-            for j in range(ysteps):
-                block = np.stack([self.rim[
-                    i*self.xps:i*self.xps + self.xps,
-                    j*self.yps:j*self.yps + self.yps,
-                :]], axis=-1)
-                D = block - colour
-                mean = np.mean(np.abs(np.mean(np.mean(D, axis=0), axis=0))**DIST_POWER, axis=0)**(1/DIST_POWER)
-                dist = np.mean(np.mean(np.mean(np.abs(D)**DIST_POWER, axis=2)**(1/DIST_POWER), axis=0), axis=0)
-                dist += mean > np.min(mean)
-                index = np.argmin(dist)
-                self.pim[
-                    i*self.xps:i*self.xps + self.xps,
-                    j*self.yps:j*self.yps + self.yps,
-                    :] = colour[:,:,:,index]
-                self.nim[
-                    i*self.xps:i*self.xps + self.xps,
-                    j*self.yps:j*self.yps + self.yps,
-                    ] = option[:,:,index]
-                perc = int(100*(1 + i*ysteps + j)/(xsteps*ysteps))
-                sys.stdout.write('\033[F\033[K')
-                print(f'{perc}% of pixel image: {self.timer()}')
+
+        def progress(done, total):
+            sys.stdout.write('\033[F\033[K')
+            print(f'{int(100*done/total)}% of pixel image: {self.timer()}')
+
+        self.profiler.count('blocks_matched', self.nx*self.ny/(self.xps*self.yps))
+        with self.profiler.stage('matching'):
+            iim = self.match_blocks(option, progress)
         sys.stdout.write('\033[F\033[K')
-        fig, ax = self.set_image(self.pim)
-        fig.savefig(osp.join(self.save_dir, IMAGE_FILE))
-        plt.close()
+        return {'iim' : iim}
+
+    def match_blocks(self, option, progress):
+        palette = convert_palette(self.rgb, self.metric)
+        if self.xps*self.yps == 1:
+            index = palette_index(self.rgb, DIST_POWER, self.lut, self.metric, self.cache)
+            if self.dither == 'none':
+                iim = index.query(self.rim)
+            else:
+                iim = dither(self.rim, index, self.dither)
+            iim = iim.astype(index_dtype(len(palette)))
+        elif self.search == 'brute':
+            iim = match_blocks(convert(self.rim, self.metric), palette, option, self.max_memory, progress)
+        else:
+            iim = search_blocks(
+                convert(self.rim, self.metric),
+                palette=palette,
+                xps=self.xps,
+                yps=self.yps,
+                exact=self.exact,
+                max_memory=self.max_memory,
+                progress=progress,
+            )
+        return iim
+
+    def match_image(self):
+        if self.cache is not None:
+            params = [
+                self.stage_keys['rim'],
+                self.rgb,
+                self.xps,
+                self.yps,
+                self.search,
+                self.exact,
+                self.lut,
+                self.dither,
+                self.metric,
+                DIST_POWER,
+            ]
+        else:
+            params = None
+        self.iim = self.cached('index', params, self.match)['iim']
+
+    def pixel_im(self):
+        self.match_image()
+        file = osp.join(self.save_dir, IMAGE_FILE)
+        if not self.is_rendered([file], fingerprint(self.iim, self.colour_table, self.dpi, self.backend)):
+            with self.profiler.stage('render_image'):
+                render.save_image(self.pim, self.dpi, file, self.backend, compression=self.compression)
+            self.profiler.count('figures_saved')
         print(f'Time to pixelize image: {self.timer()}')
 
     def number_im(self):
-        if not osp.exists(osp.join(self.save_dir, IMAGES_PER_NUMBER_FOLDER)):
-            os.makedirs(osp.join(self.save_dir, IMAGES_PER_NUMBER_FOLDER))
+        if not self.archive:
+            os.makedirs(osp.join(self.save_dir, IMAGES_PER_NUMBER_FOLDER), exist_ok=True)
         self.plates = {}
-        for num in np.unique(self.nim):
-            count = int(np.sum(self.nim == num))
+        tasks = []
+        iim_fingerprint = fingerprint(self.iim, self.colour_table)
+        for index in self.colour_indices(self.counts):
+            num = int(self.numbers[index])
+            count = int(self.counts[index])
             plates = int(np.ceil(count/PIXELS_PER_SQUARE))
-            self.plates[int(num)] = {
+            self.plates[num] = {
                 'plates' : plates,
                 'pixels' : count,
                 'extras' : PIXELS_PER_SQUARE*plates - count,
             }
-            im = self.nim == num
-            is_light = np.mean(np.array([
-                np.mean(self.pim[:,:,0][im]),
-                np.mean(self.pim[:,:,1][im]),
-                np.mean(self.pim[:,:,2][im]),
-            ])) > 1 - NIM_THRESHOLD
-            im = np.stack([im], axis=-1)
-            if is_light:
-                im = im*self.pim + (1 - im)*(1 - NIM_RATIO)*self.pim
-            else:
-                im = im*self.pim + (1 - im)*(NIM_RATIO + (1 - NIM_RATIO)*self.pim)
-            fig, ax = self.set_image(im)
-            fig.savefig(osp.join(self.save_dir, IMAGES_PER_NUMBER_FOLDER, f'{num}:{count}({plates}).png'))
-            plt.close()
+            file = osp.join(self.save_dir, IMAGES_PER_NUMBER_FOLDER, f'{num}:{count}({plates}).png')
+            if self.is_rendered([file], fingerprint(iim_fingerprint, index, self.dpi, self.backend), self.writer.exists):
+                self.profiler.count('figures_skipped')
+                continue
+            is_light = self.brightness[index] > 1 - NIM_THRESHOLD
+            tasks.append((index, self.iim, self.colour_table, is_light, self.dpi, file, self.backend))
+        for images in render.render_all(render.render_number, tasks, self.workers, self.compression):
+            for image in images:
+                self.writer.write(*image)
+            self.profiler.count('figures_saved')
         with open(osp.join(self.save_dir, PLATES_INFO), 'w') as p:
             json.dump(self.plates, p, indent=2)
 
-    @staticmethod
-    def draw_grid(ax, figsize, plateshift, platewidth, plateheight):
-        for x in range(1 + figsize[0]):
-            ax.plot(
-                [plateshift[0] + x*platewidth/figsize[0]]*2,
-                [plateshift[1], plateshift[1] + plateheight],
-                **GRID_PARAMS
-            )
-        for y in range(1 + figsize[1]):
-            ax.plot(
-                [plateshift[0], plateshift[0] + platewidth],
-                [plateshift[1] + y*plateheight/figsize[1]]*2,
-                **GRID_PARAMS
-            )
-
-    def draw_info(self, ax, xpos, ypos, cnum, npix):
-        s = f'plate {xpos}x{ypos}\ncolour {cnum}\npixels: '
-        nsquares = int(npix/PIXELS_PER_SQUARE)
-        if nsquares:
-            leftovers = npix - PIXELS_PER_SQUARE*nsquares
-            s += f'{nsquares}x{PIXELS_PER_SQUARE} + {leftovers}'
-        else:
-            s += f'{npix}'
-        ax.text(s=f'Image: {self.im_name}', **IM_NAME_PARAMS)
-        ax.text(s=s, **PLATE_INFO_PARAMS)
-        ax.add_patch(Rectangle(color=self.rgb[str(cnum)], **PLATE_COLOUR_PARAMS))
-
     def plates_im(self):
         print(f'0% of pixel plates: {self.timer()}')
-        if not osp.exists(osp.join(self.save_dir, PLATES_FOLDER)):
-            os.makedirs(osp.join(self.save_dir, PLATES_FOLDER))
-        figsize = PIXELPLATE_SIZE[::-1]
-        platewidth = figsize[0]*PLATE_RATIO
-        plateheight = figsize[1]*PLATE_RATIO
-        plateshift = (
-            (figsize[0] - platewidth)/2,
-            (figsize[1] - plateheight)/2,
-        )
-        extent = (
-            plateshift[0],
-            plateshift[0] + platewidth,
-            plateshift[1],
-            plateshift[1] + plateheight,
-        )
+        if not self.archive:
+            os.makedirs(osp.join(self.save_dir, PLATES_FOLDER), exist_ok=True)
+        tasks = []
         for i in range(self.xdim):
             for j in range(self.ydim):
-                nim_plate = self.nim[
+                iim_plate = self.iim[
                         i*self.pixelplate[0]:(i+1)*self.pixelplate[0],
                         j*self.pixelplate[1]:(j+1)*self.pixelplate[1],
                 ]
-                for num in np.unique(nim_plate):
-                    im = nim_plate != num
-                    if self.pixelplate[0] < self.pixelplate[1]:
-                        im = im.T[::-1,:]
-                    xpos = j + 1
-                    ypos = self.xdim - i
-                    cnum = num
-                    npix = np.sum(nim_plate == num)
-                    fig, ax = self.set_image(im, figsize=figsize, cmap='gray', extent=extent)
-                    self.draw_grid(ax, figsize, plateshift, platewidth, plateheight)
-                    self.draw_info(ax, xpos, ypos, cnum, npix)
-                    fig.savefig(osp.join(self.save_dir, PLATES_FOLDER, f'{xpos}x{ypos}({cnum}).png'))
-                    plt.close()
-                perc = int(100*(1 + i*self.ydim + j)/(self.xdim*self.ydim))
-                sys.stdout.write('\033[F\033[K')
-                print(f'{perc}% of pixel plates: {self.timer()}')
+                indices = self.colour_indices(self.plate_counts[i,j])
+                numbers = self.numbers[indices]
+                colours = self.colour_table[indices]
+                counts = self.plate_counts[i,j,indices]
+                xpos = j + 1
+                ypos = self.xdim - i
+                files = [
+                    osp.join(self.save_dir, PLATES_FOLDER, f'{xpos}x{ypos}({cnum}).png')
+                    for cnum in numbers
+                ]
+                transpose = self.pixelplate[0] < self.pixelplate[1]
+                plate_fingerprint = fingerprint(iim_plate, numbers, colours, xpos, ypos, transpose, self.im_name, self.dpi, self.backend)
+                if not self.is_rendered(files, plate_fingerprint, self.writer.exists):
+                    tasks.append((iim_plate, indices, numbers, colours, counts, xpos, ypos, transpose, self.im_name, self.dpi, files, self.backend))
+                else:
+                    self.profiler.count('figures_skipped', len(files))
+        for index, images in enumerate(render.render_all(render.render_plate, tasks, self.workers, self.compression)):
+            for image in images:
+                self.writer.write(*image)
+            self.profiler.count('figures_saved', len(images))
+            perc = int(100*(1 + index)/len(tasks))
+            sys.stdout.write('\033[F\033[K')
+            print(f'{perc}% of pixel plates: {self.timer()}')
         sys.stdout.write('\033[F\033[K')
         print(f'Time to get pixel plates: {self.timer()}')
 
@@ -223,8 +291,37 @@ class Pixel(PixelInit):
                     p.write(f'{col}\t{pixels[col]}\n')
 
     def run(self):
+        if self.no_output:
+            self.match_image()
+            with self.profiler.stage('statistics'):
+                self.statistics()
+            return
         self.pixel_im()
         if not self.draft:
-            self.number_im()
-            self.plates_im()
-            self.summarize_plates()
\ No newline at end of file
+            with self.profiler.stage('statistics'):
+                self.statistics()
+            self.clean_figures()
+            self.writer = Writer(
+                compression=self.compression,
+                archive=osp.join(self.save_dir, ARCHIVE_FILE) if self.archive else None,
+                root=self.save_dir,
+            )
+            try:
+                with self.profiler.stage('number_im'):
+                    self.number_im()
+                with self.profiler.stage('plates_im'):
+                    self.plates_im()
+            except BaseException:
+                self.writer.abort()
+                raise
+            with self.profiler.stage('write'):
+                self.writer.close(keep=self.rendered)
+            with self.profiler.stage('summarize'):
+                self.summarize_plates()
+            self.clean_output([IMAGES_PER_NUMBER_FOLDER, PLATES_FOLDER])
+        else:
+            self.clean_output([])
+        if self.cache is not None:
+            self.profiler.count('cache_hits', self.cache.hits)
+            self.profiler.count('cache_misses', self.cache.misses)
+        self.profiler.save(self.save_dir)
\ No newline at end of file
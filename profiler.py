@@ -0,0 +1,97 @@
+import os.path as osp
+import sys
+import json
+import cProfile
+from contextlib import contextmanager
+from time import time, process_time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from config import *
+
+
+def peak_rss():
+    '''
+    Peak resident memory of the process in megabytes, or None if it cannot be measured.
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss/2**20
+    return rss/2**10
+
+
+def cpu_time():
+    '''
+    CPU time of the process and of its terminated children, such as the workers of a closed process pool.
+    The children still running are not counted.
+    '''
+    cpu = process_time()
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu += children.ru_utime + children.ru_stime
+    return cpu
+
+
+class Profiler(object):
+    '''
+    Record the wall time, CPU time and peak memory of each stage of a run, and counters.
+    The peak memory of a stage is how much it raised the peak resident memory of the process,
+    0 for a stage staying under the peak of the previous stages, the total being the peak of the whole run.
+    The CPU time includes the process pools of a stage, which are closed before the stage ends.
+    A cProfile of the whole run can also be recorded.
+    '''
+
+    def __init__(self, cprofile=False):
+        self.start_time = time()
+        self.start_cpu = cpu_time()
+        self.stages = {}
+        self.counters = {}
+        self.cprofile = None
+        if cprofile:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def elapsed(self):
+        return time() - self.start_time
+
+    @contextmanager
+    def stage(self, name):
+        wall = time()
+        cpu = cpu_time()
+        peak = peak_rss()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'calls' : 0, 'wall' : 0., 'cpu' : 0., 'peak_rss' : 0.})
+            stage['calls'] += 1
+            stage['wall'] += time() - wall
+            stage['cpu'] += cpu_time() - cpu
+            if peak is None:
+                stage['peak_rss'] = None
+            else:
+                stage['peak_rss'] += peak_rss() - peak
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def to_dict(self):
+        return {
+            'total' : {
+                'wall' : self.elapsed(),
+                'cpu' : cpu_time() - self.start_cpu,
+                'peak_rss' : peak_rss(),
+            },
+            'stages' : self.stages,
+            'counters' : self.counters,
+        }
+
+    def save(self, folder):
+        with open(osp.join(folder, PROFILE_FILE), 'w') as p:
+            json.dump(self.to_dict(), p, indent=2)
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(osp.join(folder, PROFILE_STATS))
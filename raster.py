@@ -0,0 +1,74 @@
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from config import *
+
+
+def to_uint8(im):
+    return np.round(RGB_MAX_INT*np.clip(im, 0, 1)).astype(np.uint8)
+
+
+def upscale(im, rows, cols):
+    '''
+    Upscale an image so that each cell covers the pixels between consecutive row and column edges.
+    '''
+    im = np.repeat(im, np.diff(rows), axis=0)
+    return np.repeat(im, np.diff(cols), axis=1)
+
+
+def draw_image(im, dpi):
+    '''
+    Draw the pixels of an image of cells, each cell being a square of dpi pixels.
+    '''
+    return np.repeat(np.repeat(to_uint8(im), dpi, axis=0), dpi, axis=1)
+
+
+def draw_lines(canvas, positions, start, end, width, axis):
+    offsets = np.arange(width) - width//2
+    lines = np.clip((positions[:,None] + offsets).ravel(), 0, np.size(canvas, axis=axis) - 1)
+    if axis == 1:
+        canvas[start:end,lines] = RASTER_GRID_COLOUR
+    else:
+        canvas[lines,start:end] = RASTER_GRID_COLOUR
+
+
+def font(fontsize, dpi):
+    size = max(1, int(round(fontsize*dpi/POINTS_PER_INCH)))
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def draw_plate(im, layout, im_name, info, colour, dpi):
+    '''
+    Draw the pixels of the sheet of a plate, drawing the cells, the grid, and the information strip in bulk.
+    The layout is the one of render.plate_layout, in data units of one inch.
+    '''
+    figsize, plateshift, platewidth, plateheight, extent = layout
+    width = figsize[0]*dpi
+    height = figsize[1]*dpi
+    canvas = np.full((height, width, RGB_DIM), RGB_MAX_INT, dtype=np.uint8)
+    cols = np.round(dpi*np.linspace(extent[0], extent[1], np.size(im, axis=1) + 1)).astype(int)
+    rows = np.round(height - dpi*np.linspace(extent[3], extent[2], np.size(im, axis=0) + 1)).astype(int)
+    cells = np.where(im, RGB_MAX_INT, 0).astype(np.uint8)
+    canvas[rows[0]:rows[-1],cols[0]:cols[-1]] = upscale(cells, rows, cols)[...,None]
+    lw = max(1, int(round(GRID_PARAMS['lw']*dpi/POINTS_PER_INCH)))
+    draw_lines(canvas, cols, rows[0], rows[-1], lw, axis=1)
+    draw_lines(canvas, rows, cols[0], cols[-1], lw, axis=0)
+    x, y = PLATE_COLOUR_PARAMS['xy']
+    side = int(round(COLOUR_SIDE*dpi))
+    top = int(round(height - dpi*y)) - side
+    left = int(round(dpi*x))
+    canvas[max(top, 0):top + side,left:left + side] = to_uint8(np.array(colour))
+    sheet = Image.fromarray(canvas)
+    draw = ImageDraw.Draw(sheet)
+    for s, params in [(f'Image: {im_name}', IM_NAME_PARAMS), (info, PLATE_INFO_PARAMS)]:
+        draw.multiline_text(
+            (dpi*params['x'], height - dpi*params['y']),
+            s,
+            fill=RASTER_TEXT_COLOUR,
+            font=font(params['fontsize'], dpi),
+            anchor='ld',
+        )
+    return np.asarray(sheet)
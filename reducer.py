@@ -0,0 +1,73 @@
+import numpy as np
+
+from config import *
+
+
+def block_mean(im, nx, ny, mult, dx=0, dy=0):
+    '''
+    Average the image over a grid of nx by ny blocks of size mult, starting at (dx, dy).
+    The blocks are reduced with a single reshape instead of a loop over the cells.
+    '''
+    crop = im[dx:dx + mult*nx, dy:dy + mult*ny, :]
+    crop = np.reshape(crop, (nx, mult, ny, mult, np.size(im, axis=-1)))
+    return np.mean(np.mean(crop, axis=1), axis=2)
+
+
+def area_integral(im, bounds, axis):
+    im = np.moveaxis(im, axis, 0)
+    cumsum = np.zeros((len(im) + 1,) + im.shape[1:])
+    np.cumsum(im, axis=0, out=cumsum[1:])
+    index = np.minimum(np.floor(bounds).astype(int), len(im) - 1)
+    frac = np.reshape(bounds - index, (-1,) + (1,)*(im.ndim - 1))
+    integral = cumsum[index] + frac*im[index]
+    return np.moveaxis(integral, 0, axis)
+
+
+def area_mean(im, nx, ny, xalign=0.5, yalign=0.5):
+    '''
+    Average the image over a grid of nx by ny cells using area-weighted resampling.
+    The cells keep the aspect ratio of the grid and can have a non-integer size,
+    pixels on the border of two cells contributing to both proportionally to their overlap.
+    '''
+    imx = np.size(im, axis=0)
+    imy = np.size(im, axis=1)
+    scale = min(imx/nx, imy/ny)
+    assert scale > 0
+    xbounds = xalign*(imx - scale*nx) + scale*np.arange(nx + 1)
+    ybounds = yalign*(imy - scale*ny) + scale*np.arange(ny + 1)
+    rim = np.diff(area_integral(im, xbounds, axis=0), axis=0)
+    rim = np.diff(area_integral(rim, ybounds, axis=1), axis=1)
+    return rim/scale**2
+
+
+def strip_block_mean(source, nx, ny, mult, dx=0, dy=0, strip_rows=STRIP_ROWS):
+    '''
+    Same as block_mean, reading the image from the source by strips of whole cells of about strip_rows rows.
+    '''
+    cells = max(1, int(strip_rows/mult))
+    rim = np.zeros((nx, ny, RGB_DIM))
+    for start in range(0, nx, cells):
+        end = min(start + cells, nx)
+        strip = source.read(dx + mult*start, dx + mult*end)
+        rim[start:end] = block_mean(strip, end - start, ny, mult, 0, dy)
+    return rim
+
+
+def strip_area_mean(source, nx, ny, xalign=0.5, yalign=0.5, strip_rows=STRIP_ROWS):
+    '''
+    Same as area_mean, reading the image from the source by strips of strip_rows rows.
+    Each strip adds the part of the cells it overlaps.
+    '''
+    scale = min(source.imx/nx, source.imy/ny)
+    assert scale > 0
+    xbounds = xalign*(source.imx - scale*nx) + scale*np.arange(nx + 1)
+    ybounds = yalign*(source.imy - scale*ny) + scale*np.arange(ny + 1)
+    first = int(np.floor(xbounds[0]))
+    last = min(int(np.ceil(xbounds[-1])), source.imx)
+    rim = np.zeros((nx, ny, RGB_DIM))
+    for start in range(first, last, strip_rows):
+        end = min(start + strip_rows, last)
+        strip = np.diff(area_integral(source.read(start, end), ybounds, axis=1), axis=1)
+        bounds = np.clip(xbounds, start, end) - start
+        rim += np.diff(area_integral(strip, bounds, axis=0), axis=0)
+    return rim/scale**2
@@ -0,0 +1,173 @@
+import os
+import numpy as np
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+from config import *
+from writer import write_png, encode_png
+import raster
+
+
+def pyplot():
+    '''
+    Import pyplot when the first figure is drawn, with a headless backend unless MPLBACKEND is set.
+    '''
+    import matplotlib
+    if 'MPLBACKEND' not in os.environ:
+        matplotlib.use(MPL_BACKEND)
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def set_image(im, figsize, dpi, extent=None, cmap=None):
+    if extent is None:
+        extent = (0, figsize[0], 0, figsize[1])
+    fig = pyplot().figure(figsize=figsize, dpi=dpi)
+    fig.subplots_adjust(left=0, right=1, bottom=0, top=1)
+    ax = fig.add_subplot()
+    ax.axis('off')
+    ax.set_xlim(xmin=0, xmax=figsize[0])
+    ax.set_ylim(ymin=0, ymax=figsize[1])
+    ax.imshow(im, extent=extent, cmap=cmap)
+    return fig, ax
+
+
+def plate_layout():
+    figsize = PIXELPLATE_SIZE[::-1]
+    platewidth = figsize[0]*PLATE_RATIO
+    plateheight = figsize[1]*PLATE_RATIO
+    plateshift = (
+        (figsize[0] - platewidth)/2,
+        (figsize[1] - plateheight)/2,
+    )
+    extent = (
+        plateshift[0],
+        plateshift[0] + platewidth,
+        plateshift[1],
+        plateshift[1] + plateheight,
+    )
+    return figsize, plateshift, platewidth, plateheight, extent
+
+
+def draw_grid(ax, figsize, plateshift, platewidth, plateheight):
+    for x in range(1 + figsize[0]):
+        ax.plot(
+            [plateshift[0] + x*platewidth/figsize[0]]*2,
+            [plateshift[1], plateshift[1] + plateheight],
+            **GRID_PARAMS
+        )
+    for y in range(1 + figsize[1]):
+        ax.plot(
+            [plateshift[0], plateshift[0] + platewidth],
+            [plateshift[1] + y*plateheight/figsize[1]]*2,
+            **GRID_PARAMS
+        )
+
+
+def plate_info(xpos, ypos, cnum, npix):
+    s = f'plate {xpos}x{ypos}\ncolour {cnum}\npixels: '
+    nsquares = int(npix/PIXELS_PER_SQUARE)
+    if nsquares:
+        leftovers = npix - PIXELS_PER_SQUARE*nsquares
+        s += f'{nsquares}x{PIXELS_PER_SQUARE} + {leftovers}'
+    else:
+        s += f'{npix}'
+    return s
+
+
+def draw_info(ax, im_name, xpos, ypos, cnum, npix, colour):
+    from matplotlib.patches import Rectangle
+    ax.text(s=f'Image: {im_name}', **IM_NAME_PARAMS)
+    ax.text(s=plate_info(xpos, ypos, cnum, npix), **PLATE_INFO_PARAMS)
+    ax.add_patch(Rectangle(color=colour, **PLATE_COLOUR_PARAMS))
+
+
+def figure_pixels(fig):
+    fig.canvas.draw()
+    pixels = np.array(fig.canvas.buffer_rgba())
+    pyplot().close(fig)
+    return pixels
+
+
+def draw_image(im, dpi, backend='matplotlib', cmap=None):
+    '''
+    Draw an image of cells, returning its pixels and the dpi of the figure (None for the raster backend).
+    '''
+    if backend == 'raster':
+        return raster.draw_image(im, dpi), None
+    fig, ax = set_image(im, figsize=np.shape(im)[1::-1], dpi=dpi, cmap=cmap)
+    return figure_pixels(fig), dpi
+
+
+def save_image(im, dpi, file, backend='matplotlib', cmap=None, compression=PNG_COMPRESSION):
+    write_png(file, *draw_image(im, dpi, backend, cmap), compression)
+
+
+def render_number(task):
+    '''
+    Draw the image highlighting the pixels of a single colour.
+    The task holds the palette index of the colour, the image of palette indices, the colours of the palette,
+    whether the colour is light, the dpi, the file name, and the backend.
+    Returns the file, the pixels and the figure dpi of the image, to be written by the output writer.
+    '''
+    index, iim, colours, is_light, dpi, file, backend = task
+    pim = colours[iim]
+    im = iim == index
+    im = np.stack([im], axis=-1)
+    if is_light:
+        im = im*pim + (1 - im)*(1 - NIM_RATIO)*pim
+    else:
+        im = im*pim + (1 - im)*(NIM_RATIO + (1 - NIM_RATIO)*pim)
+    return [(file, *draw_image(im, dpi, backend))]
+
+
+def render_plate(task):
+    '''
+    Draw the images of each colour of a single plate.
+    The task holds the plate of palette indices, the indices, numbers, colours and pixel counts of its plates,
+    its position, the image name, the dpi, the file names, and the backend.
+    Returns the file, the pixels and the figure dpi of each image, to be written by the output writer.
+    '''
+    iim_plate, indices, numbers, colours, counts, xpos, ypos, transpose, im_name, dpi, files, backend = task
+    layout = plate_layout()
+    figsize, plateshift, platewidth, plateheight, extent = layout
+    images = []
+    for index, num, colour, npix, file in zip(indices, numbers, colours, counts, files):
+        im = iim_plate != index
+        if transpose:
+            im = im.T[::-1,:]
+        if backend == 'raster':
+            images.append((file, raster.draw_plate(im, layout, im_name, plate_info(xpos, ypos, num, npix), colour, dpi), None))
+            continue
+        fig, ax = set_image(im, figsize=figsize, dpi=dpi, cmap='gray', extent=extent)
+        draw_grid(ax, figsize, plateshift, platewidth, plateheight)
+        draw_info(ax, im_name, xpos, ypos, num, npix, colour)
+        images.append((file, figure_pixels(fig), dpi))
+    return images
+
+
+def render_encoded(func, compression, task):
+    return [(file, encode_png(pixels, dpi, compression)) for file, pixels, dpi in func(task)]
+
+
+def render_all(func, tasks, workers=1, compression=PNG_COMPRESSION):
+    '''
+    Run the rendering tasks in order, on a pool of processes if workers is not 1 (0 using all cores).
+    Yields the images of each finished task, already encoded as png bytes by the pool processes.
+    At most WRITER_BUFFER tasks, and at least one per process, are submitted ahead of the ones yielded,
+    so that the rendered images do not pile up in memory.
+    '''
+    if workers == 1:
+        yield from map(func, tasks)
+    else:
+        with ProcessPoolExecutor(max_workers=workers or None) as executor:
+            window = max(WRITER_BUFFER, workers or os.cpu_count())
+            func = partial(render_encoded, func, compression)
+            futures = deque()
+            for task in tasks:
+                futures.append(executor.submit(func, task))
+                if len(futures) >= window:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
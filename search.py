@@ -0,0 +1,120 @@
+import itertools
+import math
+import numpy as np
+
+from config import *
+from matcher import to_blocks, from_blocks
+from palette import index_dtype
+
+
+def multisets(n, k):
+    '''
+    List all the multisets of k elements among n, as sorted rows of indices.
+    '''
+    sets = np.arange(n)[:,None]
+    for _ in range(k - 1):
+        counts = n - sets[:,-1]
+        starts = np.cumsum(counts) - counts
+        values = np.arange(np.sum(counts)) - np.repeat(starts - sets[:,-1], counts)
+        sets = np.concatenate([np.repeat(sets, counts, axis=0), values[:,None]], axis=1)
+    return sets
+
+
+def cell_costs(blocks, palette):
+    D = blocks[...,None,:] - palette
+    cost = np.mean(np.abs(D)**DIST_POWER, axis=-1)**(1/DIST_POWER)
+    return np.reshape(cost, (len(blocks), -1, len(palette)))
+
+
+def mean_distance(means, colours):
+    return np.mean(np.abs(means - colours)**DIST_POWER, axis=-1)**(1/DIST_POWER)
+
+
+def best_permutation(cost, sets):
+    '''
+    Find the best way to place the colours of a multiset in the cells of each block.
+    Returns the colour index of each cell and the corresponding mean cell cost.
+    '''
+    ncells = np.size(sets, axis=1)
+    perms = np.array(list(itertools.permutations(range(ncells))))
+    assign = sets[:,perms]
+    dist = np.take_along_axis(cost[:,None,:,:], assign[...,None], axis=-1)
+    dist = np.mean(dist[...,0], axis=-1)
+    best = np.argmin(dist, axis=1)
+    index = np.arange(len(sets))
+    return assign[index,best], dist[index,best]
+
+
+def exact_search(blocks, cost, palette, tree, sets):
+    '''
+    Find all the multisets whose mean is the closest to the block's, up to SEARCH_TOLERANCE,
+    and keep the best placement among them.
+    '''
+    means = np.mean(blocks, axis=(1, 2))
+    dist, _ = tree.query(means, k=1)
+    ind = tree.query_radius(means, r=dist[:,0] + SEARCH_TOLERANCE)
+    ties = np.array([len(tie) for tie in ind])
+    block = np.repeat(np.arange(len(blocks)), ties)
+    index, tie_dist = best_permutation(cost[block], sets[np.concatenate(ind)])
+    best = np.lexsort((tie_dist, block))[np.cumsum(ties) - ties]
+    return index[best]
+
+
+def greedy_search(blocks, cost, palette, tree):
+    means = np.mean(blocks, axis=(1, 2))
+    index = np.argmin(cost, axis=-1)
+    ncells = np.size(index, axis=1)
+    for _ in range(SEARCH_ROUNDS):
+        changed = False
+        for cell in range(ncells):
+            rest = np.sum(palette[index], axis=1) - palette[index[:,cell]]
+            _, new = tree.query(ncells*means - rest, k=1)
+            new = new[:,0]
+            old_dist = mean_distance(means, (rest + palette[index[:,cell]])/ncells)
+            new_dist = mean_distance(means, (rest + palette[new])/ncells)
+            is_better = new_dist < old_dist
+            index[is_better,cell] = new[is_better]
+            changed = changed or np.any(is_better)
+        if not changed:
+            break
+    return best_permutation(cost, np.sort(index, axis=1))[0]
+
+
+def search_blocks(rim, palette, xps, yps, exact=True, max_memory=MATCH_MEMORY, progress=None):
+    '''
+    Match every block of the reduced image to its best colour pattern without listing all the patterns.
+    The mean colour of a pattern only depends on its multiset of colours:
+    the exact search finds the multiset whose mean is closest to the block's with a KD-tree,
+    then picks the best placement of its colours, while the greedy search refines the
+    multiset one cell at a time starting from the closest colour of each cell.
+    Returns the image of palette indices.
+    '''
+    from sklearn.neighbors import KDTree
+    palette = np.asarray(palette, dtype=float)
+    ncells = xps*yps
+    assert math.factorial(ncells) <= SEARCH_MAX_PERMUTATIONS, f'too many cells per pixel ({ncells}) for the multiset search'
+    xsteps = int(np.size(rim, axis=0)/xps)
+    ysteps = int(np.size(rim, axis=1)/yps)
+    blocks = to_blocks(rim, xps, yps)
+    nblocks = len(blocks)
+    if exact:
+        nsets = math.comb(len(palette) + ncells - 1, ncells)
+        assert nsets*(ncells + RGB_DIM)*8 <= max_memory*2**20, 'too many multisets for an exact search'
+        sets = multisets(len(palette), ncells)
+        tree = KDTree(np.mean(palette[sets], axis=1), metric='minkowski', p=DIST_POWER)
+    else:
+        tree = KDTree(palette, metric='minkowski', p=DIST_POWER)
+    block_bytes = 8*ncells*(RGB_DIM*len(palette) + math.factorial(ncells))
+    chunk = max(1, int(max_memory*2**20/(MATCH_MEMORY_FACTOR*block_bytes)))
+    index = np.zeros((nblocks, ncells), dtype=int)
+    for start in range(0, nblocks, chunk):
+        end = min(start + chunk, nblocks)
+        cost = cell_costs(blocks[start:end], palette)
+        if exact:
+            index[start:end] = exact_search(blocks[start:end], cost, palette, tree, sets)
+        else:
+            index[start:end] = greedy_search(blocks[start:end], cost, palette, tree)
+        if progress is not None:
+            progress(end, nblocks)
+    index = np.reshape(index, (nblocks, xps, yps)).astype(index_dtype(len(palette)))
+    return from_blocks(index, xsteps, ysteps)
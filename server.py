@@ -0,0 +1,184 @@
+import os.path as osp
+import sys
+import io
+import signal
+import json
+import tempfile
+import threading
+import multiprocessing
+import numpy as np
+from argparse import Namespace
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from config import *
+from main import get_parser, ParameterParser
+
+
+def preview(image, kwargs):
+    '''
+    Draft of an image kept in memory, the pixelized image being returned as png bytes instead of an output folder.
+    '''
+    from pixel import Pixel
+    import render
+    with redirect_stdout(io.StringIO()):
+        pixel = Pixel(image=image, no_output=1, **kwargs)
+    buffer = io.BytesIO()
+    with pixel.profiler.stage('render_image'):
+        render.save_image(pixel.pim, pixel.dpi, buffer, pixel.backend)
+    return buffer.getvalue()
+
+
+def warm_up(kwargs):
+    '''
+    Run a preview of a random image with the default parameters before forking the workers,
+    which inherit the imported modules, the plate colours, the palette indices and the colour options.
+    '''
+    from __init__ import PixelInit
+    side = max(PIXELPLATE_SIZE)*max(PixelInit.split_size(kwargs['dimension']))
+    with tempfile.TemporaryDirectory() as folder:
+        image = osp.join(folder, 'warm_up.npy')
+        np.save(image, np.random.default_rng(27).random((side, side, RGB_DIM)))
+        preview(image, {**kwargs, 'no_cache' : 1})
+
+
+class PreviewServer(ThreadingHTTPServer):
+    '''
+    Local HTTP server of draft previews.
+    The previews run on a pool of forked processes, at most queue of them waiting or running at the same time.
+    The pool is started again if one of its processes dies.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, defaults, jobs=1, queue=SERVER_QUEUE):
+        self.defaults = defaults
+        self.parser = get_parser(ParameterParser())
+        self.jobs = jobs
+        self.queue = queue
+        self.slots = threading.BoundedSemaphore(queue)
+        self.lock = threading.Lock()
+        warm_up(vars(defaults))
+        self.executor = self.start_pool()
+        super().__init__(address, PreviewHandler)
+
+    def start_pool(self):
+        executor = ProcessPoolExecutor(
+            max_workers=self.jobs or None,
+            mp_context=multiprocessing.get_context('fork'),
+        )
+        executor.submit(int).result()
+        return executor
+
+    def preview(self, image, kwargs):
+        '''
+        Run a preview on the pool, replacing the pool if it is broken by the death of one of its processes.
+        '''
+        executor = self.executor
+        try:
+            return executor.submit(preview, image, kwargs).result()
+        except BrokenProcessPool:
+            with self.lock:
+                if self.executor is executor:
+                    executor.shutdown(wait=False)
+                    self.executor = self.start_pool()
+            raise
+
+    def parse(self, query):
+        '''
+        Parse the parameters of a preview, the ones not given keeping the defaults of the server.
+        Only the parameters of SERVER_PARAMETERS can be given.
+        '''
+        argv = []
+        for key, values in query.items():
+            if key not in SERVER_PARAMETERS:
+                raise ValueError(f'unknown parameter {key}, expected one of {", ".join(SERVER_PARAMETERS)}')
+            argv += [f'--{key}', values[-1]]
+        kwargs = vars(self.parser.parse_args(argv, namespace=Namespace(**vars(self.defaults))))
+        kwargs.update(draft=1, incremental=0, profile=0)
+        kwargs.pop('image')
+        return kwargs
+
+
+class PreviewHandler(BaseHTTPRequestHandler):
+
+    def reply(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, code, message):
+        self.reply(code, 'text/plain', f'{message}\n'.encode())
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            return self.error(404, 'unknown path')
+        health = {'jobs' : self.server.jobs, 'queue' : self.server.queue}
+        self.reply(200, 'application/json', json.dumps(health).encode())
+
+    def do_POST(self):
+        '''
+        Pixelize the image of the request body, the parameters of main.py being given in the query string,
+        for example POST /pixelize?dimension=2&colours=classic with a jpeg body, replying with the png bytes.
+        '''
+        url = urlparse(self.path)
+        size = int(self.headers.get('Content-Length', 0))
+        if size > SERVER_MAX_UPLOAD*2**20:
+            self.close_connection = True
+            return self.error(413, f'images are limited to {SERVER_MAX_UPLOAD}MB')
+        body = self.rfile.read(size)
+        if url.path != '/pixelize':
+            return self.error(404, 'unknown path')
+        extension = SERVER_TYPES.get(self.headers.get('Content-Type'))
+        if extension is None:
+            return self.error(415, f'the content type should be one of {", ".join(SERVER_TYPES)}')
+        try:
+            kwargs = self.server.parse(parse_qs(url.query))
+        except ValueError as e:
+            return self.error(400, e)
+        if not self.server.slots.acquire(blocking=False):
+            return self.error(503, 'too many previews in progress')
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                image = osp.join(folder, f'preview{extension}')
+                with open(image, 'wb') as i:
+                    i.write(body)
+                png = self.server.preview(image, kwargs)
+        except BrokenProcessPool:
+            return self.error(500, 'the preview process died')
+        except Exception as e:
+            return self.error(422, repr(e))
+        finally:
+            self.server.slots.release()
+        self.reply(200, 'image/png', png)
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--host', type=str, default=SERVER_HOST,
+        help='The address the server listens to.')
+    parser.add_argument('--port', type=int, default=SERVER_PORT,
+        help='The port the server listens to.')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='The number of processes running the previews, 0 using all cores.')
+    parser.add_argument('--queue', type=int, default=SERVER_QUEUE,
+        help='The number of previews waiting or running before new requests are refused.')
+    kwargs = vars(parser.parse_args())
+    kwargs.pop('image')
+    address = (kwargs.pop('host'), kwargs.pop('port'))
+    jobs = kwargs.pop('jobs')
+    queue = kwargs.pop('queue')
+    server = PreviewServer(address, Namespace(**kwargs), jobs, queue)
+    print(f'Serving previews on http://{address[0]}:{address[1]}/pixelize')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.executor.shutdown()
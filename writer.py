@@ -0,0 +1,122 @@
+import os
+import os.path as osp
+import io
+import threading
+import zipfile
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+from config import *
+
+
+def encode_png(pixels, dpi=None, compression=PNG_COMPRESSION):
+    '''
+    Encode the pixels of an image as png bytes with a zlib compression level from 0 (fastest) to 9 (smallest).
+    The images of matplotlib figures have a dpi and are tagged as savefig does, the raster images have none.
+    '''
+    buffer = io.BytesIO()
+    if dpi is None:
+        Image.fromarray(pixels).save(buffer, format='PNG', compress_level=compression)
+    else:
+        from matplotlib.image import imsave
+        imsave(buffer, pixels, format='png', dpi=dpi, pil_kwargs={'compress_level' : compression})
+    return buffer.getvalue()
+
+
+def write_png(file, pixels, dpi=None, compression=PNG_COMPRESSION):
+    '''
+    Write the pixels of an image as a png file, or the png bytes as they are.
+    '''
+    data = pixels if isinstance(pixels, bytes) else encode_png(pixels, dpi, compression)
+    if isinstance(file, str):
+        with open(file, 'wb') as f:
+            f.write(data)
+    else:
+        file.write(data)
+
+
+class Writer(object):
+    '''
+    Output stage encoding and writing the png images on a pool of threads while the next images are drawn.
+    At most buffered images wait to be written, drawing more images waiting for a free slot.
+    The images can also be given already encoded, as png bytes.
+    If archive is set, the images are written to this single zip file, under their path relative to root.
+    The new archive is written to a temporary file replacing the archive once closed,
+    and the entries of the previous archive can be kept in it, to skip the images already up to date.
+    '''
+
+    def __init__(self, threads=WRITER_THREADS, buffered=WRITER_BUFFER, compression=PNG_COMPRESSION, archive=None, root=None):
+        self.compression = compression
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(buffered)
+        self.futures = []
+        self.root = root
+        self.archive = archive
+        self.previous = None
+        self.written = set()
+        if self.archive is not None:
+            if osp.exists(self.archive):
+                try:
+                    self.previous = zipfile.ZipFile(self.archive, 'r')
+                except zipfile.BadZipFile:
+                    self.previous = None
+            self.zip = zipfile.ZipFile(f'{self.archive}.tmp', 'w', compression=zipfile.ZIP_STORED)
+            self.lock = threading.Lock()
+
+    def exists(self, file):
+        '''
+        Whether an image was written by a previous run, in the previous archive if archiving.
+        '''
+        if self.archive is None:
+            return osp.exists(file)
+        return self.previous is not None and osp.relpath(file, self.root) in self.previous.NameToInfo
+
+    def write(self, file, image, dpi=None):
+        self.slots.acquire()
+        future = self.executor.submit(self.save, file, image, dpi)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def save(self, file, image, dpi):
+        if isinstance(image, bytes):
+            data = image
+        else:
+            data = encode_png(image, dpi, self.compression)
+        if self.archive is None:
+            write_png(file, data)
+        else:
+            with self.lock:
+                self.zip.writestr(osp.relpath(file, self.root), data)
+                self.written.add(osp.relpath(file, self.root))
+
+    def close(self, keep=()):
+        '''
+        Wait for all the images to be written, raising the first error, and replace the archive,
+        copying the entries of the previous archive listed in keep and not written again.
+        '''
+        try:
+            for future in self.futures:
+                future.result()
+        except BaseException:
+            self.abort()
+            raise
+        self.executor.shutdown()
+        if self.archive is not None:
+            if self.previous is not None:
+                for name in sorted(set(keep) - self.written):
+                    if name in self.previous.NameToInfo:
+                        self.zip.writestr(self.previous.getinfo(name), self.previous.read(name))
+                self.previous.close()
+            self.zip.close()
+            os.replace(f'{self.archive}.tmp', self.archive)
+
+    def abort(self):
+        '''
+        Stop writing the images after an error, the previous archive being left untouched.
+        '''
+        self.executor.shutdown(cancel_futures=True)
+        if self.archive is not None:
+            if self.previous is not None:
+                self.previous.close()
+            self.zip.close()
+            os.remove(f'{self.archive}.tmp')